@@ -0,0 +1,230 @@
+#benchmark -> specify mode and dataset name, prints throughput numbers for parts of the pipeline
+import time
+import random
+import argparse
+import numpy as np
+from utils.corpus import load_raw
+
+# Compare the per-sentence slow tokenizer against the batched fast tokenizer on the first num_docs documents
+# Checks that both produce identical token ids and reports sentences/s for each
+def benchmark_tokenization(dataset_name, num_docs, batch_size, workers):
+	from preprocess import tokenize_bert
+	corpus = load_raw(dataset_name, 'documents')
+	documents = [corpus[i] for i in range(min(num_docs, len(corpus)))]
+
+	results = {}
+	for tokenizer in ['slow', 'fast']:
+		t0 = time.time()
+		results[tokenizer] = tokenize_bert(documents, tokenizer, batch_size, workers)
+		results[tokenizer + '_time'] = time.time() - t0
+
+	num_sentences = sum(len(document) for document in documents)
+	identical = all(
+		len(slow_doc) == len(fast_doc) and all(slow.tolist() == fast.tolist() for slow, fast in zip(slow_doc, fast_doc))
+		for slow_doc, fast_doc in zip(results['slow'], results['fast'])
+	)
+	print('Documents: {}, sentences: {}'.format(len(documents), num_sentences))
+	print('Slow tokenizer: {:.1f} sentences/s'.format(num_sentences / results['slow_time']))
+	print('Fast tokenizer: {:.1f} sentences/s (batch size {}, {} workers)'.format(num_sentences / results['fast_time'], batch_size, workers))
+	print('Speedup: {:.2f}x, identical token ids: {}'.format(results['slow_time'] / results['fast_time'], identical))
+
+# collate_batch_bert as it was before vectorization, kept as the baseline for benchmark_collate_bert
+def collate_batch_bert_loop(batch):
+	import torch
+	batch_inputs = [item[0] for item in batch]
+	batch_labels = [item[1] for item in batch]
+	batch_size = len(batch_inputs)
+	sent_lens = [np.array([len(sent) for sent in example]) for example in batch_inputs]
+	max_sent_len = min(512, max(np.array([max(lens) for lens in sent_lens])))
+	doc_lens = np.array([len(example) for example in batch_inputs])
+	max_doc_len = max(doc_lens)
+	padded_inputs = np.zeros((batch_size, max_doc_len, max_sent_len))
+	mask = np.zeros((batch_size, max_doc_len, max_sent_len))
+	for i, example in enumerate(batch_inputs):
+		for j, sentence in enumerate(example):
+			for k, token in enumerate(sentence):
+				if(k < max_sent_len):
+					padded_inputs[i][j][k] = token
+					mask[i][j][k] = 1
+	padded_inputs = np.vstack(padded_inputs)
+	mask = np.vstack(mask)
+	batch_labels = torch.from_numpy(np.array(batch_labels)).unsqueeze(1)
+	padded_inputs = torch.from_numpy(padded_inputs).long()
+	mask = torch.from_numpy(mask).long()
+	doc_lens = torch.from_numpy(doc_lens)
+	return padded_inputs, mask, batch_labels, doc_lens
+
+# Synthetic news-like documents of token ids: 5-120 sentences of mostly 10-60 tokens with occasional very long sentences
+def get_synthetic_documents(num_docs, seed=0):
+	rng = random.Random(seed)
+	documents = []
+	for _ in range(num_docs):
+		lengths = [rng.randint(10, 60) if rng.random() > 0.02 else rng.randint(200, 512) for _ in range(rng.randint(5, 120))]
+		documents.append([np.array([101] + [rng.randint(1000, 30000) for _ in range(length - 2)] + [102], dtype=np.uint16) for length in lengths])
+	return documents
+
+# Time the loop-based and vectorized BERT collation on batches of synthetic documents, or documents of a packed BERT split
+def benchmark_collate_bert(dataset_name, num_docs, batch_size, sent_len_percentile):
+	from models.data_loader import collate_batch_bert, get_indices, RegularDataset
+	if(dataset_name is None):
+		documents = get_synthetic_documents(num_docs)
+	else:
+		indices = get_indices(dataset_name, 'bert', 'train')[:num_docs]
+		dataset = RegularDataset(dataset_name, indices, [0] * len(indices), 'train', 'bert')
+		documents = [dataset[index][0] for index in indices]
+	batches = [[(document, 0) for document in documents[i:i+batch_size]] for i in range(0, len(documents), batch_size)]
+
+	times = {}
+	for name, collate_fn in [('loop', collate_batch_bert_loop), ('vectorized', collate_batch_bert)]:
+		t0 = time.time()
+		outputs = [collate_fn(batch) for batch in batches]
+		times[name] = time.time() - t0
+		if(name == 'loop'):
+			reference = outputs
+	identical = all((a[0] == b[0]).all() and (a[1] == b[1]).all() for a, b in zip(reference, outputs))
+	print('Batches: {} of {} documents'.format(len(batches), batch_size))
+	print('Loop collation: {:.2f} ms/batch'.format(1000 * times['loop'] / len(batches)))
+	print('Vectorized collation: {:.2f} ms/batch, identical outputs: {}'.format(1000 * times['vectorized'] / len(batches), identical))
+	print('Speedup: {:.1f}x'.format(times['loop'] / times['vectorized']))
+
+	if(sent_len_percentile is not None):
+		padded = lambda outputs: sum(output[1].numel() for output in outputs)
+		truncated = [collate_batch_bert(batch, sent_len_percentile=sent_len_percentile) for batch in batches]
+		kept = sum(output[1].sum().item() for output in truncated) / sum(output[1].sum().item() for output in reference)
+		print('Truncating at the {}th percentile: {:.1f}% of padded positions, {:.1f}% of tokens kept'.format(sent_len_percentile, 100 * padded(truncated) / padded(reference), 100 * kept))
+
+# Time linear and BERT inference on synthetic documents on a device (cpu by default), reporting documents/s and sentences/s
+# BERT has the bert-base-uncased architecture with random weights, which runs at the same speed as the trained models
+def benchmark_inference(device_name, num_docs, bert_num_docs, batch_size, threads, max_sent_len):
+	import torch
+	from scipy import sparse
+	from models.linear import LinearModel
+	from utils.device import get_device, to_device
+	from models.bert import score_documents
+	from models.data_loader import collate_batch_linear, collate_batch_bert, collate_batch_bert_packed
+	from transformers import BertConfig, BertForSequenceClassification
+	device = get_device(device_name)
+	if(threads is not None):
+		torch.set_num_threads(threads)
+	print('Device: {}, threads: {}'.format(device, torch.get_num_threads()))
+
+	documents = get_synthetic_documents(num_docs)
+	num_features = 10008
+	linear_documents = [sparse.random(len(document), num_features, density=0.002, format='csr', dtype=np.float32, random_state=i) for i, document in enumerate(documents)]
+	model = LinearModel(num_features).to(device).eval()
+	t0 = time.time()
+	with torch.no_grad():
+		for i in range(0, len(linear_documents), batch_size):
+			inputs, mask, _ = to_device(collate_batch_linear([(document, 0) for document in linear_documents[i:i+batch_size]]), device)
+			model(inputs, mask)
+	elapsed = time.time() - t0
+	num_sentences = sum(len(document) for document in documents)
+	print('Linear: {:.1f} documents/s, {:.1f} sentences/s (batch size {})'.format(len(documents) / elapsed, num_sentences / elapsed, batch_size))
+
+	documents = documents[:bert_num_docs]
+	model = BertForSequenceClassification(BertConfig(num_labels=1)).to(device).eval()
+	t0 = time.time()
+	with torch.no_grad():
+		for document in documents:
+			b_input_ids, b_input_mask = to_device(collate_batch_bert([(document, 0)], max_sent_len=max_sent_len)[:2], device)
+			model(b_input_ids, token_type_ids=None, attention_mask=b_input_mask)
+	elapsed = time.time() - t0
+	num_sentences = sum(len(document) for document in documents)
+	print('BERT: {:.2f} documents/s, {:.1f} sentences/s (one document per batch, sentences capped at {} tokens)'.format(len(documents) / elapsed, num_sentences / elapsed, max_sent_len))
+
+	# The same documents packed into shared sequences of up to 512 tokens, scored at each sentence's [CLS] token
+	t0 = time.time()
+	with torch.no_grad():
+		for document in documents:
+			score_documents(model, collate_batch_bert_packed([(document, 0)], max_sent_len=max_sent_len), device)
+	elapsed = time.time() - t0
+	# Sequences and padded tokens (mask size) of both collations
+	masks = {collate_fn: [collate_fn([(document, 0)], max_sent_len=max_sent_len)[1] for document in documents] for collate_fn in [collate_batch_bert, collate_batch_bert_packed]}
+	sequences = {collate_fn: sum(mask.shape[0] for mask in masks[collate_fn]) / len(documents) for collate_fn in masks}
+	padded = {collate_fn: sum(mask.numel() for mask in masks[collate_fn]) / len(documents) for collate_fn in masks}
+	print('Packed BERT: {:.2f} documents/s, {:.1f} sentences/s ({:.1f} instead of {:.1f} sequences and {:,.0f} instead of {:,.0f} padded tokens per document)'.format(
+		len(documents) / elapsed, num_sentences / elapsed, sequences[collate_batch_bert_packed], sequences[collate_batch_bert],
+		padded[collate_batch_bert_packed], padded[collate_batch_bert]))
+
+# Train BERT (bert-base-uncased architecture, random weights) on batches of synthetic documents in precision, with
+# gradient checkpointing if checkpointing is set and gradients accumulated over accumulation_steps batches
+# Returns the time per batch in seconds (after a first warm-up batch) and the peak memory in MB
+def train_bert_steps(device_name, precision, checkpointing, num_docs, batch_size, accumulation_steps, threads, max_sent_len, pack):
+	import torch
+	from torch import nn
+	from train import bert_backward, bert_optimizer_step
+	from utils.device import get_device, peak_memory, reset_peak_memory
+	from models.data_loader import collate_batch_bert, collate_batch_bert_packed
+	from transformers import BertConfig, BertForSequenceClassification
+	device = get_device(device_name)
+	if(threads is not None):
+		torch.set_num_threads(threads)
+
+	documents = get_synthetic_documents(num_docs)
+	collate_fn = collate_batch_bert_packed if pack else collate_batch_bert
+	batches = [collate_fn([(document, len(document) // 2) for document in documents[i:i+batch_size]], max_sent_len=max_sent_len) for i in range(0, len(documents), batch_size)]
+
+	model = BertForSequenceClassification(BertConfig(num_labels=1)).to(device).train()
+	if(checkpointing):
+		model.gradient_checkpointing_enable()
+	parameters = list(model.parameters())
+	optimizer = torch.optim.AdamW(parameters, lr=2e-5, eps=1e-8)
+	scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1.0)
+	scaler = torch.cuda.amp.GradScaler() if precision == 'fp16' else None
+	criterion = nn.CrossEntropyLoss(ignore_index=-1)
+
+	bert_backward(model, batches[0], criterion, device, precision, scaler)
+	bert_optimizer_step(parameters, optimizer, scheduler, scaler)
+	reset_peak_memory(device)
+	t0 = time.time()
+	for step, batch in enumerate(batches):
+		bert_backward(model, batch, criterion, device, precision, scaler, accumulation_steps)
+		if((step + 1) % accumulation_steps == 0 or step + 1 == len(batches)):
+			bert_optimizer_step(parameters, optimizer, scheduler, scaler)
+	if(device.type == 'cuda'):
+		torch.cuda.synchronize(device)
+	return (time.time() - t0) / len(batches), peak_memory(device)
+
+# Time BERT training in every precision (fp16 only on a GPU) with and without gradient checkpointing, reporting the time
+# per batch and peak memory of each configuration so settings can be chosen for the hardware
+# Each configuration runs in a process of its own, so that the CPU peak memory (of the process) is its own
+def benchmark_train_bert(device_name, num_docs, batch_size, accumulation_steps, threads, max_sent_len, pack):
+	import multiprocessing
+	precisions = ['fp32', 'bf16'] + (['fp16'] if device_name.startswith('cuda') else [])
+	print('Device: {}, {} documents in batches of {}, {} batches per optimizer step{}'.format(device_name, num_docs, batch_size, accumulation_steps, ', packed' if pack else ''))
+	context = multiprocessing.get_context('spawn')
+	for precision in precisions:
+		for checkpointing in (False, True):
+			with context.Pool(1) as pool:
+				step_time, memory = pool.apply(train_bert_steps, (device_name, precision, checkpointing, num_docs, batch_size, accumulation_steps, threads, max_sent_len, pack))
+			print('{:>4}, gradient checkpointing {:>3}: {:,.0f} ms per batch, peak memory {:,.0f} MB'.format(precision, 'on' if checkpointing else 'off', 1000 * step_time, memory))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-dataset_name')
+	parser.add_argument('-mode')
+	# Number of documents from the dataset to benchmark on
+	parser.add_argument('-num_docs', type=int, default=1000)
+	parser.add_argument('-batch_size', type=int, default=64)
+	parser.add_argument('-workers', type=int, default=1)
+	parser.add_argument('-sent_len_percentile', type=float, default=None)
+	parser.add_argument('-max_sent_len', type=int, default=512)
+	# Options for inference benchmark
+	parser.add_argument('-device', default='cpu')
+	parser.add_argument('-threads', type=int, default=None)
+	parser.add_argument('-bert_num_docs', type=int, default=10)
+	# Options for BERT training benchmark (also uses device, threads, bert_num_docs and max_sent_len)
+	parser.add_argument('-bert_batch_size', type=int, default=1)
+	parser.add_argument('-accumulation_steps', type=int, default=1)
+	parser.add_argument('-pack', action='store_true', default=False)
+
+	args = parser.parse_args()
+
+	if(args.mode == 'tokenization'):
+		benchmark_tokenization(args.dataset_name, args.num_docs, args.batch_size, args.workers)
+	elif(args.mode == 'collate_bert'):
+		benchmark_collate_bert(args.dataset_name, args.num_docs, args.batch_size, args.sent_len_percentile)
+	elif(args.mode == 'inference'):
+		benchmark_inference(args.device, args.num_docs, args.bert_num_docs, args.batch_size, args.threads, args.max_sent_len)
+	elif(args.mode == 'train_bert'):
+		benchmark_train_bert(args.device, args.bert_num_docs, args.bert_batch_size, args.accumulation_steps, args.threads, args.max_sent_len, args.pack)
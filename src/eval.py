@@ -1,15 +1,23 @@
 import os
 import argparse
+import functools
 from rouge import Rouge
 from torch import nn, optim
 import allennlp_models.coref
 from models.linear import *
+from models.lora import add_lora, has_adapter, load_adapter
+from models.bert import score_documents
 from collections import Counter
 from models.data_loader import *
-from transformers import BertForSequenceClassification
+from utils.corpus import load_raw
+from utils.device import get_device, to_device
+from transformers import BertForSequenceClassification, BertConfig
 #from allennlp.predictors.predictor import Predictor
 #predictor = Predictor.from_path("https://storage.googleapis.com/allennlp-public-models/coref-spanbert-large-2020.02.27.tar.gz")
 
+# Base BERT models with adapters, kept in memory so that topics only swap in their adapter weights
+lora_base_models = {}
+
 rouge = Rouge()
 rouge_metric = 'f'
 rouge_type = 'rouge-1'
@@ -18,21 +26,23 @@ coref_keywords = ['the', 'it', 'they', 'its', 'a']
 # Linear prediction function, feeds each example in dataloader to linear model for a topic
 # Returns, for each example document in the dataloader, a list of indices of its sentences
 # sorted in decreasing order of the model's predicted relevance to the topic
-def predict_linear(dataloader, topic):
+def predict_linear(dataloader, topic, device=None):
+	device = get_device() if device is None else device
 	print('Running Linear model for topic {} on test data from the {} dataset...'.format(topic, dataloader.dataset.dataset_name))
 
-	load_path = '../models/{}/linear/{}.th'.format(dataloader.dataset.dataset_name, topic)
+	# Sentence embedding models are linear models over the cached embeddings, saved under their own model type
+	load_path = '../models/{}/{}/{}.th'.format(dataloader.dataset.dataset_name, dataloader.dataset.model_type, topic)
 
 	for inputs, mask, targets in dataloader:
-		num_features = inputs[0].shape[1]
+		num_features = inputs.shape[-1]
 		break
 
-	model = LinearModel(num_features).cuda()
-	model.load_state_dict(torch.load(load_path))
+	model = load_linear_model(torch.load(load_path, map_location=device), num_features).to(device)
 	model.eval()
 
 	preds = []
 	for inputs, mask, targets in dataloader:
+		inputs, mask = to_device((inputs, mask), device)
 		scores, pred = model(inputs, mask)
 		preds.append(np.argsort(scores.detach().cpu().numpy().flatten().tolist())[::-1])
 
@@ -41,31 +51,25 @@ def predict_linear(dataloader, topic):
 # BERT prediction function, feeds each example in dataloader to linear model for a topic
 # Returns, for each example document in the dataloader, a list of indices of its sentences
 # sorted in decreasing order of the model's predicted relevance to the topic
-def predict_bert(dataloader, topic):
+def predict_bert(dataloader, topic, device=None):
 	print('Running BERT model for topic {} on test data from the {} dataset...'.format(topic, dataloader.dataset.dataset_name))
 	
-	device = torch.device("cuda")
+	device = get_device() if device is None else device
 
 	load_path = '../models/{}/bert/{}/'.format(dataloader.dataset.dataset_name, topic)
 	
-	model = BertForSequenceClassification.from_pretrained(load_path).cuda()
+	model = load_bert_model(load_path, device)
 	model.eval()
 
 	preds = []
 
 	# Predict 
 	for batch in dataloader:
-		# Add batch to GPU
-		b_input_ids = batch[0].to(device)
-		b_input_mask = batch[1].to(device)
-		
 		# Telling the model not to compute or store gradients, saving memory and 
 		# speeding up prediction
 		with torch.no_grad():
-			# Forward pass, calculate logit predictions
-			outputs = model(b_input_ids, token_type_ids=None, 
-							attention_mask=b_input_mask)
-		logits = outputs[0]
+			# Forward pass, calculate logit predictions for the sentences of the document
+			logits = score_documents(model, batch, device)[0]
 		
 		# Move logits and labels to CPU
 		logits = logits.detach().cpu().numpy()
@@ -75,6 +79,53 @@ def predict_bert(dataloader, topic):
 
 	return preds
 
+# Load the BERT model saved at load_path, either a full model or adapters (see models/lora.py) which are loaded into
+# a base model that is shared by every adapter with the same configuration
+def load_bert_model(load_path, device):
+	if(not has_adapter(load_path)):
+		return BertForSequenceClassification.from_pretrained(load_path).to(device)
+	adapter = load_adapter(load_path, device)
+	config = adapter['config']
+	key = (config['base'], config['num_labels'], config['rank'], config['alpha'], tuple(config['targets']), str(device))
+	if(key not in lora_base_models):
+		model = BertForSequenceClassification.from_pretrained(config['base'], num_labels=config['num_labels']).to(device)
+		lora_base_models[key] = add_lora(model, config['rank'], config['alpha'], config['targets'])
+	model = lora_base_models[key]
+	model.load_state_dict(adapter['state_dict'], strict=False)
+	return model
+
+# Packing options (pack, pack_overlap) the BERT model saved at load_path was trained with, None if it was saved without them
+def load_bert_packing(load_path):
+	config = load_adapter(load_path)['config'] if has_adapter(load_path) else BertConfig.from_pretrained(load_path).to_dict()
+	if('pack' not in config):
+		return None
+	return config['pack'], config['pack_overlap']
+
+# Multi-topic BERT prediction function, feeds each example in dataloader to the shared encoder once and scores its
+# sentences for every topic at the same time
+# Returns, for each topic, the rankings predict_bert would return for that topic
+def predict_multi_bert(dataloader, device=None):
+	print('Running multi-topic BERT model on test data from the {} dataset...'.format(dataloader.dataset.dataset_name))
+
+	device = get_device() if device is None else device
+
+	load_path = '../models/{}/multi_bert/'.format(dataloader.dataset.dataset_name)
+
+	model = load_bert_model(load_path, device)
+	model.eval()
+
+	preds = [[] for topic in range(model.config.num_labels)]
+
+	for batch in dataloader:
+		with torch.no_grad():
+			# (num_sentences, num_topics)
+			logits = score_documents(model, batch, device)[0].detach().cpu().numpy()
+
+		for topic in range(logits.shape[1]):
+			preds[topic].append(list(np.argsort(logits[:, topic])[::-1]))
+
+	return preds
+
 # Gets index of an array in a subarray
 def get_index(array, subarray):
 	for i in range(len(array) - len(subarray) + 1):
@@ -316,10 +367,17 @@ def ranking_eval(dataloader, predict_fn, topics, documents, summaries, oracles,
 # Get all topics for which a model has been trained for a given dataset and model type
 def get_all_topics(dataset_name, model_type):
 	model_files = os.listdir('../models/{}/{}/'.format(dataset_name, model_type))
-	if(model_type == 'linear'):
-		return sorted([int(file[:-3]) for file in model_files if file != 'checkpoint.pt'])
+	if(model_type in ('linear', 'embedding')):
+		return sorted([int(file[:-3]) for file in model_files if file.endswith('.th')])
 	elif(model_type == 'bert'):
-		return sorted([int(file) for file in model_files])
+		# Topic models are numbered directories, next to e.g. training_summary.json
+		model_dir = '../models/{}/{}/'.format(dataset_name, model_type)
+		return sorted([int(file) for file in model_files if file.isdigit() and os.path.isdir(model_dir + file)])
+	elif(model_type == 'multi_bert'):
+		load_path = '../models/{}/{}/'.format(dataset_name, model_type)
+		if(has_adapter(load_path)):
+			return list(range(load_adapter(load_path)['config']['num_labels']))
+		return list(range(BertConfig.from_pretrained(load_path).num_labels))
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
@@ -331,8 +389,21 @@ if __name__ == '__main__':
 	parser.add_argument('-topics', nargs='*', type=int)
 	# Whether or not to write the summaries generated to a file in ../results/{dataset_name}/
 	parser.add_argument('-write', action='store_true', default=False)
+	# Truncation of BERT sentences, see train.py
+	parser.add_argument('-max_sent_len', type=int, default=512)
+	parser.add_argument('-sent_len_percentile', type=float, default=None)
+	# Packing of BERT documents into shared sequences, see train.py
+	# Only needed for models saved without the options they were trained with, the saved ones are used otherwise
+	parser.add_argument('-pack', action='store_true', default=None)
+	parser.add_argument('-pack_overlap', type=int, default=None)
+	# Device to run models on, e.g. cpu, cuda or cuda:1 - auto uses the GPU if there is one
+	parser.add_argument('-device', default='auto')
+	# Number of worker processes loading and collating batches, and how many batches each keeps ready
+	parser.add_argument('-num_workers', type=int, default=0)
+	parser.add_argument('-prefetch_factor', type=int, default=2)
 
 	args = parser.parse_args()
+	device = get_device(args.device)
 
 	dataset_name, model_type, mode, topics, write = \
 		args.dataset_name, args.model_type, args.mode, args.topics, args.write
@@ -341,9 +412,25 @@ if __name__ == '__main__':
 	if(mode != 'vanilla' or topics is None):
 		topics = get_all_topics(dataset_name, model_type)
 
+	# BERT models are evaluated with the packing options they were trained with, scores are wrong with any others
+	pack, pack_overlap = bool(args.pack), 2 if args.pack_overlap is None else args.pack_overlap
+	if(model_type in ('bert', 'multi_bert')):
+		if(model_type == 'bert'):
+			load_paths = ['../models/{}/bert/{}/'.format(dataset_name, topic) for topic in topics]
+		else:
+			load_paths = ['../models/{}/multi_bert/'.format(dataset_name)]
+		saved = set(load_bert_packing(load_path) for load_path in load_paths) - {None}
+		if(len(saved) > 1):
+			parser.error('The models were trained with different packing options {}, evaluate them separately'.format(sorted(saved)))
+		if(saved):
+			saved_pack, saved_overlap = saved.pop()
+			if((args.pack is not None and args.pack != saved_pack) or (saved_pack and args.pack_overlap is not None and args.pack_overlap != saved_overlap)):
+				parser.error('The models were trained with -pack {} -pack_overlap {}'.format(saved_pack, saved_overlap))
+			pack, pack_overlap = saved_pack, saved_overlap
+
 	# Setting topic=None makes the loader return all test examples, not just the ones from a specific topic
 	# Batch size hardcoded to 1 because it's easier to process output that way, and we don't have that many examples
-	dataloader = create_loader(dataset_name, model_type, 'test', topic=None, batch_size=1)
+	dataloader = create_loader(dataset_name, model_type, 'test', topic=None, batch_size=1, max_sent_len=args.max_sent_len, sent_len_percentile=args.sent_len_percentile, pin_memory=device.type == 'cuda', num_workers=args.num_workers, prefetch_factor=args.prefetch_factor, pack=pack, pack_overlap=pack_overlap)
 
 	# Where to write results if we do
 	save_dir = '../results/{}'.format(dataset_name)
@@ -351,11 +438,10 @@ if __name__ == '__main__':
 		os.makedirs(save_dir)
 
 	json_path = '../data/{}/raw/'.format(dataset_name)
-	
-	with open(json_path + 'documents.json') as json_file:
-		documents = json.load(json_file)
-	with open(json_path + 'summaries.json') as json_file:
-		summaries = json.load(json_file)
+
+	# Documents and summaries may be sharded stores, in which case only the test examples are read below
+	documents = load_raw(dataset_name, 'documents')
+	summaries = load_raw(dataset_name, 'summaries')
 	with open(json_path + 'oracles.json') as json_file:
 		oracles = json.load(json_file)
 	with open(json_path + 'topics.json') as json_file:
@@ -368,10 +454,14 @@ if __name__ == '__main__':
 	topic_representations = [topic_representations[k] for k in dataloader.dataset.labels]
 
 	# Prediction function based on model type
-	if(model_type == 'linear'):
-		predict_fn = predict_linear
+	if(model_type in ('linear', 'embedding')):
+		predict_fn = functools.partial(predict_linear, device=device)
 	elif(model_type == 'bert'):
-		predict_fn = predict_bert
+		predict_fn = functools.partial(predict_bert, device=device)
+	elif(model_type == 'multi_bert'):
+		# Every topic is scored in the same pass over the test set, the evaluations then look up each topic's rankings
+		multi_topic_preds = predict_multi_bert(dataloader, device=device)
+		predict_fn = lambda dataloader, topic: multi_topic_preds[topic]
 
 	if(mode == 'vanilla'):
 		model_summaries = vanilla_eval(dataloader, predict_fn, topics, documents, summaries)
@@ -0,0 +1,36 @@
+import torch
+from utils.device import to_device
+
+'''
+Sentence scoring with BertForSequenceClassification models, on batches of either collation of BERT documents
+Per-sentence batches (see collate_batch_bert) encode every sentence as its own sequence and score it with the model's
+usual head, packed batches (see collate_batch_bert_packed) encode several sentences per sequence and score each with
+the same pooler and head applied to its own [CLS] token, so a model trained with one can be used with the other
+'''
+
+# Logits (num_sentences, num_labels) of every sentence of a packed batch, in document order
+def score_packed(model, input_ids, input_mask, token_types, cls_index):
+	hidden = model.bert(input_ids, attention_mask=input_mask, token_type_ids=token_types)[0]
+	pooler = model.bert.pooler
+	pooled = pooler.activation(pooler.dense(hidden[cls_index[:, 0], cls_index[:, 1]]))
+	return model.classifier(model.dropout(pooled))
+
+# Score the sentences of a collated batch of documents, encoding only the real sentences and not the all-zero rows
+# padding each document to max_doc_len (or packing them, for packed batches)
+# Returns the logits scattered back per document, (batch_size, max_doc_len, num_labels), with padding sentences
+# at -inf so that a softmax over dim 1 is a softmax over the sentences of each document
+def score_documents(model, batch, device):
+	input_ids, input_mask = to_device(batch[:2], device)
+	doc_lens = batch[3]
+	batch_size = len(doc_lens)
+	max_doc_len = int(doc_lens.max())
+	doc_index = torch.repeat_interleave(torch.arange(batch_size), doc_lens)
+	sent_index = torch.arange(int(doc_lens.sum())) - torch.repeat_interleave(torch.cumsum(doc_lens, 0) - doc_lens, doc_lens)
+	if(len(batch) > 4):
+		logits = score_packed(model, input_ids, input_mask, *to_device(batch[4:6], device))
+	else:
+		rows = (doc_index * max_doc_len + sent_index).to(device)
+		logits = model(input_ids[rows], token_type_ids=None, attention_mask=input_mask[rows])[0]
+	scores = torch.full((batch_size, max_doc_len, logits.shape[-1]), float('-inf'), dtype=logits.dtype, device=logits.device)
+	scores[doc_index.to(logits.device), sent_index.to(logits.device)] = logits
+	return scores
@@ -1,55 +1,128 @@
 import os
+import copy
 import json
 import torch
 import random
+import functools
 import numpy as np
+from scipy import sparse
 from torch.utils import data
 from itertools import accumulate, permutations
-from torch.utils.data import Dataset, DataLoader, Sampler, SubsetRandomSampler
+from torch.utils.data import Dataset, DataLoader, Sampler, BatchSampler, SubsetRandomSampler
 from sklearn.model_selection import train_test_split
+from models.linear import load_linear_model
+from utils.feature_store import get_split_format, load_sparse_split, load_sparse_doc_ids, load_packed_doc_ids, load_embedding_split, PackedTokenStore
+
+# Per-split index of documents and oracle labels for every topic, written by preprocess.py (see write_topic_index)
+TOPIC_INDEX_PATH = '../data/{}/index/{}.npz'
+
+# Stack sparse per-document feature matrices into a sparse (batch_size * max_len, num_features) tensor
+# Row i * max_len + j holds sentence j of document i, rows for padded sentences are left empty
+def collate_sparse_linear(batch_inputs, lengths, max_len, num_features):
+	stacked = sparse.vstack(batch_inputs, format='coo')
+	doc_indices = np.repeat(np.arange(len(batch_inputs)), lengths)[stacked.row]
+	positions = stacked.row - (np.cumsum(lengths) - lengths)[doc_indices]
+	indices = torch.from_numpy(np.vstack([doc_indices * max_len + positions, stacked.col])).long()
+	values = torch.from_numpy(stacked.data).float()
+	return torch.sparse_coo_tensor(indices, values, (len(batch_inputs) * max_len, num_features)).coalesce()
 
 # From a batch (list of items returned by dataloader), generate padded inputs and attention masks and return all
+# Sparse feature matrices are kept sparse (see collate_sparse_linear), dense ones are padded to (batch_size, max_len, num_features)
+# Tensors are returned on the CPU, moving them to the model's device is up to the caller
 def collate_batch_linear(batch):
 	batch_inputs = [item[0] for item in batch]
-	batch_labels = torch.from_numpy(np.array([item[1] for item in batch])).unsqueeze(1).cuda()
+	# (batch_size, 1) for a single topic, (batch_size, num_topics) when documents have a label for every topic
+	batch_labels = torch.from_numpy(np.array([item[1] for item in batch])).reshape(len(batch), -1)
 	batch_size = len(batch_inputs)
-	lengths = np.array([len(example) for example in batch_inputs])
+	lengths = np.array([example.shape[0] for example in batch_inputs])
 	max_len = max(lengths)
 	num_features = batch_inputs[0].shape[1]
-	padded_inputs = np.zeros((batch_size, max_len, num_features))
-	for i, example in enumerate(batch_inputs):
-		for j, sentence in enumerate(example):
-			padded_inputs[i][j] = sentence
 	mask = torch.arange(max_len) >= torch.from_numpy(lengths)[:, None]
-	padded_inputs = torch.from_numpy(padded_inputs).float().cuda()
-	mask = mask.type(torch.uint8).to(torch.bool).cuda()
+	mask = mask.type(torch.uint8).to(torch.bool)
+	if(sparse.issparse(batch_inputs[0])):
+		padded_inputs = collate_sparse_linear(batch_inputs, lengths, max_len, num_features)
+		return padded_inputs, mask, batch_labels
+	# Scatter all sentences of the batch into the padded buffer at once
+	padded_inputs = np.zeros((batch_size, max_len, num_features), dtype=np.float32)
+	doc_indices = np.repeat(np.arange(batch_size), lengths)
+	positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+	padded_inputs[doc_indices, positions] = np.concatenate([np.asarray(example) for example in batch_inputs])
+	padded_inputs = torch.from_numpy(padded_inputs)
 	return padded_inputs, mask, batch_labels
 
 # From a batch (list of items returned by dataloader), generate padded inputs and attention masks and return all
-def collate_batch_bert(batch):
+# Sentences are truncated to max_sent_len tokens, or if sent_len_percentile is set, to that percentile of the
+# sentence lengths in the batch if it is shorter, so a few very long sentences don't set the padding for the whole batch
+def collate_batch_bert(batch, max_sent_len=512, sent_len_percentile=None):
 	batch_inputs = [item[0] for item in batch]
 	batch_labels = [item[1] for item in batch]
 	batch_size = len(batch_inputs)
-	sent_lens = np.array([np.array([len(sent) for sent in example]) for example in batch_inputs])
-	max_sent_len = min(512, max(np.array([max(lens) for lens in sent_lens])))
 	doc_lens = np.array([len(example) for example in batch_inputs])
 	max_doc_len = max(doc_lens)
-	padded_inputs = np.zeros((batch_size, max_doc_len, max_sent_len))
-	mask = np.zeros((batch_size, max_doc_len, max_sent_len))
-	for i, example in enumerate(batch_inputs):
-		for j, sentence in enumerate(example):
-			for k, token in enumerate(sentence):
-				if(k < max_sent_len):
-					padded_inputs[i][j][k] = token
-					mask[i][j][k] = 1
-	padded_inputs = np.vstack(padded_inputs)
-	mask = np.vstack(mask)
-	batch_labels = torch.from_numpy(np.array(batch_labels)).unsqueeze(1)
-	padded_inputs = torch.from_numpy(padded_inputs).long()
-	mask = torch.from_numpy(mask).long()
+	sentences = [sentence for example in batch_inputs for sentence in example]
+	sent_lens = np.array([len(sentence) for sentence in sentences])
+	if(sent_len_percentile is not None):
+		max_sent_len = min(max_sent_len, int(np.ceil(np.percentile(sent_lens, sent_len_percentile))))
+	max_sent_len = min(max_sent_len, max(sent_lens))
+	sent_lens = np.minimum(sent_lens, max_sent_len)
+	# Row of each sentence in the (batch_size * max_doc_len) rows, then row and column of every kept token
+	sent_rows = np.repeat(np.arange(batch_size) * max_doc_len, doc_lens) + np.arange(len(sentences)) - np.repeat(np.cumsum(doc_lens) - doc_lens, doc_lens)
+	token_rows = np.repeat(sent_rows, sent_lens)
+	token_cols = np.arange(sent_lens.sum()) - np.repeat(np.cumsum(sent_lens) - sent_lens, sent_lens)
+	tokens = np.concatenate([np.asarray(sentence[:max_sent_len], dtype=np.int64) for sentence in sentences])
+	padded_inputs = np.zeros((batch_size * max_doc_len, max_sent_len), dtype=np.int64)
+	mask = np.zeros((batch_size * max_doc_len, max_sent_len), dtype=np.int32)
+	padded_inputs[token_rows, token_cols] = tokens
+	mask[token_rows, token_cols] = 1
+	batch_labels = torch.from_numpy(np.array(batch_labels)).reshape(batch_size, -1)
+	padded_inputs = torch.from_numpy(padded_inputs)
+	mask = torch.from_numpy(mask)
 	doc_lens = torch.from_numpy(doc_lens)
 	return padded_inputs, mask, batch_labels, doc_lens
 
+# BertSum-style collation: pack the sentences of each document into as few sequences of at most window tokens as
+# possible instead of one sequence per sentence. Sentences keep their own [CLS] and [SEP] tokens, get alternating
+# segment ids, and are scored at their [CLS] token. Documents that don't fit in one window are split into windows of
+# whole sentences, each starting with up to overlap sentences of the previous window as context (scored there)
+# Returns padded windows (num_windows, window_len), mask, labels, doc_lens, segment ids, and the window and position
+# of the [CLS] token of every sentence of the batch (num_sentences, 2) in document order
+def collate_batch_bert_packed(batch, max_sent_len=512, window=512, overlap=2):
+	batch_inputs = [item[0] for item in batch]
+	batch_labels = [item[1] for item in batch]
+	batch_size = len(batch_inputs)
+	doc_lens = np.array([len(example) for example in batch_inputs])
+	max_sent_len = min(max_sent_len, window)
+	windows, segments, cls_index = [], [], []
+	for example in batch_inputs:
+		sentences = [np.asarray(sentence[:max_sent_len], dtype=np.int64) for sentence in example]
+		sent_lens = np.array([len(sentence) for sentence in sentences])
+		first = 0
+		while(first < len(sentences)):
+			# Context from the previous window, as many of its last overlap sentences as leave room for the next one
+			start = max(first - overlap, 0)
+			while(sent_lens[start:first+1].sum() > window):
+				start += 1
+			end = first + 1
+			while(end < len(sentences) and sent_lens[start:end+1].sum() <= window):
+				end += 1
+			offsets = np.cumsum(sent_lens[start:end]) - sent_lens[start:end]
+			cls_index.extend([len(windows), offset] for offset in offsets[first-start:])
+			windows.append(np.concatenate(sentences[start:end]))
+			segments.append(np.repeat(np.arange(end - start) % 2, sent_lens[start:end]))
+			first = end
+	window_lens = np.array([len(tokens) for tokens in windows])
+	rows = np.repeat(np.arange(len(windows)), window_lens)
+	cols = np.arange(window_lens.sum()) - np.repeat(np.cumsum(window_lens) - window_lens, window_lens)
+	padded_inputs = np.zeros((len(windows), max(window_lens)), dtype=np.int64)
+	token_types = np.zeros((len(windows), max(window_lens)), dtype=np.int64)
+	mask = np.zeros((len(windows), max(window_lens)), dtype=np.int32)
+	padded_inputs[rows, cols] = np.concatenate(windows)
+	token_types[rows, cols] = np.concatenate(segments)
+	mask[rows, cols] = 1
+	batch_labels = torch.from_numpy(np.array(batch_labels)).reshape(batch_size, -1)
+	return torch.from_numpy(padded_inputs), torch.from_numpy(mask), batch_labels, torch.from_numpy(doc_lens), \
+		torch.from_numpy(token_types), torch.from_numpy(np.array(cls_index, dtype=np.int64))
+
 # "Reduce" document from old_len to new_len, preserving the sentence at index label
 def get_mini_indices(old_len, new_len, label):
 	if(new_len >= old_len):
@@ -66,6 +139,13 @@ def get_mini_indices(old_len, new_len, label):
 		indices[new_label] = label
 		return indices, new_label
 
+# Features of the sentences at indices of a document, in that order
+# Lists of per-sentence tokens can't be indexed with a list of indices, matrices can
+def select_sentences(features, indices):
+	if(isinstance(features, list)):
+		return [features[i] for i in indices]
+	return features[indices]
+
 # Sampler that always iterates in the same order
 class SubsetSequentialSampler(Sampler):
     def __init__(self, indices):
@@ -77,100 +157,403 @@ class SubsetSequentialSampler(Sampler):
     def __len__(self):
         return len(self.indices)
 
+# Batch sampler that groups documents of similar length so that batches need little padding
+# Documents are shuffled, split into pools of pool_size batches' worth, sorted by length within each pool and cut into
+# batches, then the batches are shuffled. If max_tokens is set, batches are filled until their padded size
+# (documents * most sentences * longest sentence) would go over max_tokens, instead of having batch_size documents
+class BucketBatchSampler(Sampler):
+	def __init__(self, indices, sent_counts, sent_lens, batch_size, max_tokens=None, pool_size=50, shuffle=True):
+		self.indices = np.array(indices)
+		self.sent_counts = np.asarray(sent_counts)
+		self.sent_lens = np.asarray(sent_lens)
+		self.batch_size = batch_size
+		self.max_tokens = max_tokens
+		self.pool_size = pool_size
+		self.shuffle = shuffle
+		self.batches = self.get_batches()
+
+	def get_batches(self):
+		order = np.random.permutation(len(self.indices)) if self.shuffle else np.arange(len(self.indices))
+		pool_len = self.batch_size * self.pool_size
+		batches = []
+		for start in range(0, len(order), pool_len):
+			pool = order[start:start+pool_len]
+			pool = pool[np.lexsort((self.sent_lens[pool], self.sent_counts[pool]))]
+			batch, max_count, max_len = [], 0, 0
+			for i in pool:
+				new_count, new_len = max(max_count, self.sent_counts[i]), max(max_len, self.sent_lens[i])
+				full = len(batch) >= self.batch_size if self.max_tokens is None else (len(batch) + 1) * new_count * new_len > self.max_tokens
+				if(batch and full):
+					batches.append(batch)
+					batch, new_count, new_len = [], self.sent_counts[i], self.sent_lens[i]
+				batch.append(int(self.indices[i]))
+				max_count, max_len = new_count, new_len
+			if(batch):
+				batches.append(batch)
+		if(self.shuffle):
+			random.shuffle(batches)
+		return batches
+
+	# Batches for the next epoch are drawn as soon as this epoch's are handed out, so __len__ is that of the upcoming epoch
+	def __iter__(self):
+		batches, self.batches = self.batches, self.get_batches()
+		return iter(batches)
+
+	def __len__(self):
+		return len(self.batches)
+
+# Batch sampler of train/val loaders, hands out the batches of batch_sampler unless the batches of the next epoch are
+# set with set_batches, e.g. an order drawn beforehand or the rest of an epoch resumed part way through
+# Setting them on the loader's own sampler keeps its persistent workers, which a new loader would start again
+class EpochBatchSampler(Sampler):
+	def __init__(self, batch_sampler):
+		self.batch_sampler = batch_sampler
+		self.batches = None
+
+	def set_batches(self, batches):
+		self.batches = batches
+
+	# Set batches are only used for one epoch. They are taken once iteration starts, as a DataLoader starting its
+	# workers creates an iterator of its sampler that it never uses
+	def __iter__(self):
+		if(self.batches is None):
+			yield from self.batch_sampler
+		else:
+			batches, self.batches = self.batches, None
+			yield from batches
+
+	def __len__(self):
+		return len(self.batch_sampler) if self.batches is None else len(self.batches)
+
 # Main Dataset class
+# Reads one .pt file per document, a row slice of the split's CSR matrix for sparse linear features or of the
+# memory-mapped embeddings for sentence embeddings, or zero-copy slices of the memory-mapped token store for packed BERT tokens
 class RegularDataset(Dataset):
 	def __init__(self, dataset_name, indices, labels, dataset_type, model_type):
 		self.dataset_name = dataset_name
 		self.labels = {indices[i] : labels[i] for i in range(len(labels))}
 		self.dataset_type = dataset_type
 		self.model_type = model_type
+		self.path = '../data/{}/{}/{}/'.format(dataset_name, model_type, dataset_type)
+		self.format = get_split_format(self.path)
+		self.matrix = None
+		self.store = PackedTokenStore(self.path) if self.format == 'packed' else None
 
 	def __len__(self):
 		return len(self.labels)
 
+	# Copy of a dataset created for all topics that only has the documents with a label for topic, labelled for it
+	# Features (e.g. a preloaded split) are shared with this dataset, not copied
+	def topic_subset(self, topic):
+		subset = copy.copy(self)
+		subset.labels = {index : int(label[topic]) for index, label in self.labels.items() if label[topic] >= 0}
+		return subset
+
+	# Sparse matrix (or embeddings) for the split is loaded on first access (so once per worker process)
+	def load_features(self, index):
+		if(self.format == 'packed'):
+			return self.store.get(index)
+		elif(self.format == 'pt'):
+			return torch.load(self.path + str(index) + '.pt')
+		if(self.matrix is None):
+			load_split = load_sparse_split if self.format == 'sparse' else load_embedding_split
+			self.matrix, doc_offsets, doc_ids = load_split(self.path)
+			self.rows = {doc_id : (doc_offsets[i], doc_offsets[i+1]) for i, doc_id in enumerate(doc_ids.tolist())}
+		start, end = self.rows[index]
+		return self.matrix[start:end]
+
 	def __getitem__(self, index):
-		path = '../data/{}/{}/{}/{}.pt'.format(self.dataset_name, self.model_type, self.dataset_type, str(index))
-		features = torch.load(path)
+		features = self.load_features(index)
 		label = self.labels[index]
 		return features, label
 
+	# Number of sentences and length of the longest sentence (1 for linear features) of every document, in the order of self.labels
+	def doc_lengths(self):
+		indices = list(self.labels)
+		if(self.format == 'packed'):
+			self.store.open()
+			rows = np.array([self.store.rows[index] for index in indices], dtype=np.int64)
+			doc_offsets = np.asarray(self.store.doc_offsets)
+			sent_lens = np.append(np.diff(self.store.sent_offsets), 0)
+			sent_counts = np.diff(doc_offsets)
+			# Longest sentence per document, documents without sentences get 0
+			max_lens = np.where(sent_counts > 0, np.maximum.reduceat(sent_lens, doc_offsets[:-1]), 0)
+			return sent_counts[rows], max_lens[rows]
+		elif(self.format in ('sparse', 'embedding') and indices):
+			# Loads the split's rows if they haven't been yet
+			self.load_features(indices[0])
+			sent_counts = np.array([self.rows[index][1] - self.rows[index][0] for index in indices])
+			return sent_counts, np.ones_like(sent_counts)
+		features = [self.load_features(index) for index in indices]
+		sent_counts = np.array([len(document) for document in features], dtype=np.int64)
+		if(self.model_type != 'bert'):
+			return sent_counts, np.ones_like(sent_counts)
+		return sent_counts, np.array([max([len(sentence) for sentence in document], default=0) for document in features])
+
+# Loads all documents of a linear split once into a single contiguous float32 buffer (or keeps the split's CSR matrix
+# for sparse features, or its float16 embeddings), so no files are read after construction and items are zero-copy slices of the buffer
+class PreloadedDataset(RegularDataset):
+	def __init__(self, dataset_name, indices, labels, dataset_type, model_type):
+		super(PreloadedDataset, self).__init__(dataset_name, indices, labels, dataset_type, model_type)
+		if(self.format in ('sparse', 'embedding')):
+			load_split = load_sparse_split if self.format == 'sparse' else load_embedding_split
+			matrix, doc_offsets, doc_ids = load_split(self.path)
+			split_rows = {doc_id : (doc_offsets[i], doc_offsets[i+1]) for i, doc_id in enumerate(doc_ids.tolist())}
+			# Keep only the rows of documents in this dataset
+			rows = [np.arange(*split_rows[index]) for index in self.labels]
+			matrix = matrix[np.concatenate(rows)] if rows else matrix[:0]
+		else:
+			features = [np.asarray(torch.load(self.path + str(index) + '.pt'), dtype=np.float32) for index in self.labels]
+			matrix = np.concatenate(features) if features else np.zeros((0, 0), dtype=np.float32)
+			rows = features
+		lengths = [len(row) for row in rows]
+		offsets = np.cumsum([0] + lengths)
+		self.rows = {index : (offsets[i], offsets[i+1]) for i, index in enumerate(self.labels)}
+		self.matrix = matrix
+
+	def load_features(self, index):
+		start, end = self.rows[index]
+		return self.matrix[start:end]
+
+# Estimate of how many bytes PreloadedDataset would need for documents indices of a split
+def estimate_preload_bytes(dataset_name, model_type, dataset_type, indices):
+	path = '../data/{}/{}/{}/'.format(dataset_name, model_type, dataset_type)
+	split_format = get_split_format(path)
+	if(split_format == 'sparse'):
+		with np.load(path + 'features.npz') as npz:
+			# float32 data and int32 column indices for every stored value, scaled to the share of documents kept
+			return int(npz['indptr'][-1] * 8 * len(indices) / max(len(npz['doc_ids']), 1))
+	elif(split_format == 'embedding'):
+		# Kept as float16
+		embeddings, doc_offsets, doc_ids = load_embedding_split(path)
+		return int(embeddings.nbytes * len(indices) / max(len(doc_ids), 1))
+	# .pt files hold float64 tensors, the buffer is float32
+	return sum(os.path.getsize(path + str(index) + '.pt') for index in indices) // 2
+
 # Mini means we keep K sentences from the original document, including the oracle (K=10)
-class MiniDataset(Dataset):
+class MiniDataset(RegularDataset):
 	def __init__(self, dataset_name, indices, labels, dataset_type, model_type, minidoc_size=10):
-		self.dataset_name = dataset_name
+		super(MiniDataset, self).__init__(dataset_name, indices, labels, dataset_type, model_type)
 		self.minidoc_size = minidoc_size
-		self.labels = {indices[i] : labels[i] for i in range(len(labels))}
-		self.dataset_type = dataset_type
-		self.model_type = model_type
 
-	def __len__(self):
-		return len(self.labels)
+	def doc_lengths(self):
+		sent_counts, sent_lens = super(MiniDataset, self).doc_lengths()
+		return np.minimum(sent_counts, self.minidoc_size), sent_lens
 
 	def __getitem__(self, index):
-		path = '../data/{}/{}/{}/{}.pt'.format(self.dataset_name, self.model_type, self.dataset_type, str(index))
-		features = torch.load(path)
+		features = self.load_features(index)
 		label = self.labels[index]
 		# "Reduce" document to minidoc_size sentences
-		indices, label = get_mini_indices(len(features), self.minidoc_size, label)
-		features = torch.tensor([features[i] for i in indices])
-		return features, label
+		indices, label = get_mini_indices(features.shape[0] if self.format == 'sparse' else len(features), self.minidoc_size, label)
+		return select_sentences(features, indices), label
+
+# Hard negatives means we keep the oracle and the negatives other sentences a trained linear model of the topic scores
+# highest, so every sentence BERT encodes is one that is hard to tell apart from the oracle
+# Each epoch, negatives are drawn from the pool highest scoring other sentences (always the highest if pool is not set)
+# Sentences are ranked once, the sentences kept for an epoch are chosen once by set_epoch (get_loader does it for epoch 0)
+# Created for all topics (topic None), the dataset can only be used through topic_subset
+class HardNegativeDataset(RegularDataset):
+	def __init__(self, dataset_name, indices, labels, dataset_type, model_type, topic=None, negatives=9, pool=None):
+		super(HardNegativeDataset, self).__init__(dataset_name, indices, labels, dataset_type, model_type)
+		self.topic = topic
+		self.negatives = negatives
+		self.pool = max(pool or negatives, negatives)
+		self.rankings = None
+		self.kept = None
+
+	def topic_subset(self, topic):
+		subset = super(HardNegativeDataset, self).topic_subset(topic)
+		subset.topic, subset.rankings, subset.kept = topic, None, None
+		return subset
+
+	def set_epoch(self, epoch):
+		if(self.rankings is None):
+			self.rankings = rank_sentences(self.dataset_name, self.dataset_type, self.topic, list(self.labels))
+		rng = np.random.default_rng(epoch)
+		self.kept = {}
+		for index, label in self.labels.items():
+			candidates = self.rankings[index][self.rankings[index] != label][:self.pool]
+			if(len(candidates) > self.negatives):
+				candidates = rng.choice(candidates, self.negatives, replace=False)
+			# Sentences stay in document order
+			self.kept[index] = np.sort(np.append(candidates, label))
+
+	def doc_lengths(self):
+		sent_counts, sent_lens = super(HardNegativeDataset, self).doc_lengths()
+		return np.minimum(sent_counts, self.negatives + 1), sent_lens
+
+	def __getitem__(self, index):
+		features = self.load_features(index)
+		indices = self.kept[index]
+		label = int(np.searchsorted(indices, self.labels[index]))
+		return select_sentences(features, indices), label
+
+# Sentences of documents indices of a split, ranked by the saved linear model of topic on their linear features
+# Returns {document : array of sentence indices, highest scoring first}
+def rank_sentences(dataset_name, dataset_type, topic, indices, batch_size=64):
+	print('Ranking sentences of {} {} documents with the linear model of topic {}...'.format(len(indices), dataset_type, topic))
+	data = RegularDataset(dataset_name, indices, [0] * len(indices), dataset_type, 'linear')
+	model_path = '../models/{}/linear/{}.th'.format(dataset_name, topic)
+	if(not os.path.exists(model_path)):
+		raise FileNotFoundError('Hard negatives need the linear model of topic {} ({}), train it first'.format(topic, model_path))
+	state_dict = torch.load(model_path, map_location='cpu')
+	model = None
+	rankings = {}
+	with torch.no_grad():
+		for i in range(0, len(indices), batch_size):
+			batch_indices = indices[i:i+batch_size]
+			inputs, mask, _ = collate_batch_linear([data[index] for index in batch_indices])
+			if(model is None):
+				model = load_linear_model(state_dict, inputs.shape[-1]).eval()
+			scores = model(inputs, mask)[0][:, :, 0].numpy()
+			for index, doc_scores, length in zip(batch_indices, scores, (~mask).sum(1).tolist()):
+				rankings[index] = np.argsort(-doc_scores[:length], kind='stable')
+	return rankings
 
 # Get indices for dataset and model type train/test/val data
 def get_indices(dataset_name, model_type, dataset_type):
 	path = '../data/{}/{}/{}/'.format(dataset_name, model_type, dataset_type)
+	split_format = get_split_format(path)
+	if(split_format == 'sparse'):
+		return load_sparse_doc_ids(path).tolist()
+	elif(split_format in ('packed', 'embedding')):
+		return load_packed_doc_ids(path).tolist()
 	files = os.listdir(path)
 	indices = [int(file[:-3]) for file in files if file.endswith('.pt')]
 	return indices
 
+# Oracle label of every document (rows) for every topic (columns): the oracle sentence for the first sentence of
+# its summary of that topic, or -1 if the summary has no sentence of that topic
+def get_topic_labels(topic_representations, oracles):
+	num_topics = 1 + max([topic for representation in topic_representations for topics in representation for topic in topics], default=-1)
+	labels = np.full((len(oracles), num_topics), -1, dtype=np.int32)
+	for i, (representation, oracle) in enumerate(zip(topic_representations, oracles)):
+		for j in range(len(representation)):
+			for topic in representation[j]:
+				if(labels[i][topic] == -1):
+					labels[i][topic] = oracle[j]
+	return labels
+
+# Get the documents of a split and the oracle label of each for every topic, or None if the index hasn't been built
+def load_topic_index(dataset_name, dataset_type):
+	path = TOPIC_INDEX_PATH.format(dataset_name, dataset_type)
+	if(not os.path.exists(path)):
+		return None
+	with np.load(path) as npz:
+		return npz['doc_ids'], npz['labels']
+
 # Create loader that returns examples from some dataset (features of model_type), train/test/val set and a specific topic
-def create_loader(dataset_name, model_type, dataset_type, topic, batch_size, mini=False):
+# (or all topics at once if topic is 'all')
+# If preload is set, linear features are loaded into memory once (see PreloadedDataset) unless that would take more than
+# preload_max_gb gigabytes, in which case features are read from disk as usual
+# max_sent_len and sent_len_percentile set how BERT sentences are truncated (see collate_batch_bert)
+# If bucket is set, train/val batches group documents of similar length (see BucketBatchSampler), with at most
+# max_tokens padded sentences (linear) or tokens (BERT) per batch instead of batch_size documents if max_tokens is set
+# pin_memory should be set when batches are moved to a GPU, so the copies can be non-blocking
+# If num_workers is set, documents are loaded and collated by that many persistent worker processes,
+# each keeping prefetch_factor batches ready so loading overlaps with the forward and backward passes
+# If pack is set, the sentences of each BERT document are packed into shared sequences with pack_overlap sentences of
+# context between windows (see collate_batch_bert_packed)
+# If negatives is set, documents are reduced to their oracle and that many hard negatives (see HardNegativeDataset)
+def create_loader(dataset_name, model_type, dataset_type, topic, batch_size, mini=False, preload=False, preload_max_gb=8.0, max_sent_len=512, sent_len_percentile=None, bucket=False, max_tokens=None, pin_memory=False, num_workers=0, prefetch_factor=2, pack=False, pack_overlap=2, negatives=None, negative_pool=None):
+	data = create_dataset(dataset_name, model_type, dataset_type, topic, mini, preload, preload_max_gb, negatives, negative_pool)
+	return get_loader(data, batch_size, max_sent_len, sent_len_percentile, bucket, max_tokens, pin_memory, num_workers, prefetch_factor, pack, pack_overlap)
+
+# Create the dataset create_loader loads batches from, see create_loader for the arguments
+# Mini and hard negative datasets (which keep the oracle of a single topic) created for all topics can only be used through topic_subset
+def create_dataset(dataset_name, model_type, dataset_type, topic, mini=False, preload=False, preload_max_gb=8.0, negatives=None, negative_pool=None):
+	# Multi-topic BERT models are trained on the same features as BERT models
+	model_type = 'bert' if model_type == 'multi_bert' else model_type
 	print('Creating {} {} dataloader for {} dataset...'.format(model_type, dataset_type, dataset_name))
-	json_path = '../data/' + dataset_name + '/raw/'
-	with open(json_path + 'oracles.json') as json_file:
-		oracles = json.load(json_file)
-	with open(json_path + 'topics.json') as json_file:
-		topic_representations = json.load(json_file)
 
-	# Get indices for dataset and model type train/test/val data
-	indices = get_indices(dataset_name, model_type, dataset_type)
+	# Use the topic index if it has been built, otherwise compute the same labels from the json files
+	topic_index = load_topic_index(dataset_name, dataset_type)
+	if(topic_index is not None):
+		doc_ids, topic_labels = topic_index
+	else:
+		json_path = '../data/' + dataset_name + '/raw/'
+		with open(json_path + 'oracles.json') as json_file:
+			oracles = json.load(json_file)
+		with open(json_path + 'topics.json') as json_file:
+			topic_representations = json.load(json_file)
+
+		# Get indices for dataset and model type train/test/val data
+		doc_ids = np.array(get_indices(dataset_name, model_type, dataset_type), dtype=np.int64)
+		topic_labels = get_topic_labels(topic_representations, oracles)[doc_ids]
 
 	# Set all labels to 0 if topic is None (done for for test mode only) since we don't use the labels in any of our evaluation schemes
 	# If topic is None, we don't filter by topic and return all test data since none of our evaluation schemes require a target
+	# If topic is all, keep examples where summary has a sentence of any topic, labelled with their label for every topic (-1 if none)
 	# Otherwise keep examples where summary has at least 1 sentence of topic for which we're making dataloader
 	if(topic is None):
-		labels = [0] * len(indices)
+		indices, labels = doc_ids.tolist(), [0] * len(doc_ids)
+	elif(topic == 'all'):
+		keep = (topic_labels >= 0).any(axis=1)
+		indices, labels = doc_ids[keep].tolist(), list(topic_labels[keep].astype(np.int64))
+	elif(topic < topic_labels.shape[1]):
+		keep = topic_labels[:, topic] >= 0
+		indices, labels = doc_ids[keep].tolist(), topic_labels[keep, topic].tolist()
 	else:
-		labels = []
-		indices = [i for i in indices if any([topic in representation for representation in topic_representations[i]])]
-		for i in indices:
-			representation, oracle = topic_representations[i], oracles[i]
-			for j in range(len(representation)):
-				if(topic in representation[j]):
-					labels.append(oracle[j])
-					break
+		# Topics that never occur in the summaries have no column
+		indices, labels = [], []
 
 	# Mini means we keep K sentences from the original document, including the oracle (K=10)
 	DatasetType = MiniDataset if mini else RegularDataset
 
+	if(negatives is not None and topic is not None):
+		DatasetType = functools.partial(HardNegativeDataset, topic=None if topic == 'all' else topic, negatives=negatives, pool=negative_pool)
+
+	if(preload and not mini and model_type in ('linear', 'embedding')):
+		preload_bytes = estimate_preload_bytes(dataset_name, model_type, dataset_type, indices)
+		if(preload_bytes <= preload_max_gb * 1024 ** 3):
+			DatasetType = PreloadedDataset
+		else:
+			print('Preloading would need {:.1f}GB, more than the {:.1f}GB cap, reading features from disk instead'.format(preload_bytes / 1024 ** 3, preload_max_gb))
+
 	# Initialize dataset
-	data = DatasetType(dataset_name, indices, labels, dataset_type, model_type)
-	
+	return DatasetType(dataset_name, indices, labels, dataset_type, model_type)
+
+# Create a loader over the documents of a dataset, see create_loader for the arguments
+def get_loader(data, batch_size, max_sent_len=512, sent_len_percentile=None, bucket=False, max_tokens=None, pin_memory=False, num_workers=0, prefetch_factor=2, pack=False, pack_overlap=2):
+	indices, dataset_type, model_type = list(data.labels), data.dataset_type, data.model_type
+
 	# Define samplers, for test always use same order and for train/val randomize
+	batch_sampler = None
 	if(dataset_type == 'test'):
 		sampler = SubsetSequentialSampler(indices)
+	elif(bucket):
+		sent_counts, sent_lens = data.doc_lengths()
+		batch_sampler = EpochBatchSampler(BucketBatchSampler(indices, sent_counts, np.minimum(sent_lens, max_sent_len), batch_size, max_tokens))
 	else:
-		sampler = SubsetRandomSampler(indices)
+		batch_sampler = EpochBatchSampler(BatchSampler(SubsetRandomSampler(indices), batch_size, drop_last=False))
 
-	# Batch collation function is different for different model types
-	if(model_type == 'linear'):
+	# Batch collation function is different for different model types, sentence embeddings are collated like linear features
+	if(model_type in ('linear', 'embedding')):
 		collate_fn = collate_batch_linear
+	elif(model_type == 'bert' and pack):
+		collate_fn = functools.partial(collate_batch_bert_packed, max_sent_len=max_sent_len, overlap=pack_overlap)
 	elif(model_type == 'bert'):
-		collate_fn = collate_batch_bert
+		collate_fn = functools.partial(collate_batch_bert, max_sent_len=max_sent_len, sent_len_percentile=sent_len_percentile)
 	
+	# Worker options can only be given when there are workers
+	# Workers of hard negative datasets are started again every epoch, with the sentences kept for that epoch
+	worker_args = {'num_workers': num_workers, 'pin_memory': pin_memory}
+	if(num_workers > 0):
+		worker_args.update(persistent_workers=not isinstance(data, HardNegativeDataset), prefetch_factor=prefetch_factor)
+	if(isinstance(data, HardNegativeDataset) and data.kept is None):
+		data.set_epoch(0)
+
 	# Load training data, collated and in batches
-	loader = torch.utils.data.DataLoader(data,
-											batch_size=batch_size,
-											sampler=sampler,
-											collate_fn=collate_fn)
+	if(batch_sampler is not None):
+		loader = torch.utils.data.DataLoader(data,
+												batch_sampler=batch_sampler,
+												collate_fn=collate_fn,
+												**worker_args)
+	else:
+		loader = torch.utils.data.DataLoader(data,
+												batch_size=batch_size,
+												sampler=sampler,
+												collate_fn=collate_fn,
+												**worker_args)
 	
 	return loader
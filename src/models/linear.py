@@ -3,18 +3,40 @@ import torch.nn as nn
 
 torch.manual_seed(1)
 	
+# With num_topics > 1, scores sentences for every topic at once, the softmax over sentences is taken per topic
+# If mlp is set, sentences go through a hidden layer of size hidden with a ReLU first (shared by all topics)
 class LinearModel(nn.Module):
-	def __init__(self, input_dim, hidden=512):
+	def __init__(self, input_dim, hidden=512, num_topics=1, mlp=False):
 		super(LinearModel, self).__init__()
-		self.linear = nn.Linear(input_dim, 1)
-		#self.ReLU = nn.ReLU()
-		#self.linear2 = nn.Linear(hidden, 1)
+		self.hidden_layer = nn.Linear(input_dim, hidden) if mlp else None
+		self.linear = nn.Linear(hidden if mlp else input_dim, num_topics)
+		self.ReLU = nn.ReLU()
 		self.log_softmax = nn.LogSoftmax(dim=1)
 
+	# x is either dense (batch_size, max_len, num_features) or sparse (batch_size * max_len, num_features)
 	def forward(self, x, mask=None):
-		x = self.linear(x)
-		#x = self.ReLU(x)
-		#x = self.linear2(x)
+		first = self.linear if self.hidden_layer is None else self.hidden_layer
+		if(x.is_sparse):
+			x = torch.sparse.mm(x, first.weight.t()) + first.bias
+			x = x.view(mask.shape[0], mask.shape[1], first.out_features)
+		else:
+			x = first(x)
+		if(self.hidden_layer is not None):
+			x = self.linear(self.ReLU(x))
 		x[mask] = -float("inf")
 		x = self.log_softmax(x)
-		return x, torch.argmax(x, 1)
\ No newline at end of file
+		return x, torch.argmax(x, 1)
+
+	# Weights of a single topic, as the state dict of a one topic LinearModel
+	def topic_state_dict(self, topic):
+		state_dict = {'linear.weight': self.linear.weight[topic:topic+1].detach().clone(), 'linear.bias': self.linear.bias[topic:topic+1].detach().clone()}
+		if(self.hidden_layer is not None):
+			state_dict.update({'hidden_layer.' + name : value.detach().clone() for name, value in self.hidden_layer.state_dict().items()})
+		return state_dict
+
+# Rebuild the LinearModel a state dict was saved from
+def load_linear_model(state_dict, input_dim):
+	mlp = 'hidden_layer.weight' in state_dict
+	model = LinearModel(input_dim, state_dict['hidden_layer.weight'].shape[0] if mlp else 512, state_dict['linear.weight'].shape[0], mlp)
+	model.load_state_dict(state_dict)
+	return model
\ No newline at end of file
@@ -0,0 +1,53 @@
+import os
+import torch
+import torch.nn as nn
+
+'''
+Low-rank adapters (LoRA) for BERT models
+The pretrained weights are frozen and each targeted linear layer W gets a trainable low-rank update
+W + (alpha / rank) * B A, with A (rank, in_features) and B (out_features, rank). Only the adapters and the
+classification head are trained and saved, as ../models/{dataset_name}/{model_type}/{topic}/adapter.pt
+'''
+
+ADAPTER_FILE = 'adapter.pt'
+
+class LoRALinear(nn.Module):
+	def __init__(self, base, rank=8, alpha=16):
+		super(LoRALinear, self).__init__()
+		self.base = base
+		self.lora_A = nn.Parameter(torch.zeros(rank, base.in_features))
+		self.lora_B = nn.Parameter(torch.zeros(base.out_features, rank))
+		self.scaling = alpha / rank
+		# B starts at zero so that the adapted layer starts out as the pretrained one
+		nn.init.kaiming_uniform_(self.lora_A, a=5 ** 0.5)
+
+	def forward(self, x):
+		return self.base(x) + (x @ self.lora_A.t() @ self.lora_B.t()) * self.scaling
+
+# Freeze model and add adapters to the linear layers of its encoder whose name is in targets (attention query and value by default)
+# The classification head stays trainable since it is specific to the topic
+def add_lora(model, rank=8, alpha=16, targets=('query', 'value')):
+	for parameter in model.parameters():
+		parameter.requires_grad = False
+	for name, module in list(model.named_modules()):
+		for child_name, child in list(module.named_children()):
+			if(isinstance(child, nn.Linear) and child_name in targets and 'encoder' in name):
+				setattr(module, child_name, LoRALinear(child, rank, alpha).to(child.weight.device))
+	for parameter in model.classifier.parameters():
+		parameter.requires_grad = True
+	return model
+
+# Save the trainable parameters of a model with adapters, along with what is needed to rebuild it
+# and the packing options it was trained with, if they are set in its config (see train.py)
+def save_adapter(model, path, base, rank, alpha, targets=('query', 'value')):
+	state_dict = {name : parameter.detach().cpu() for name, parameter in model.named_parameters() if parameter.requires_grad}
+	config = {'base': base, 'num_labels': model.config.num_labels, 'rank': rank, 'alpha': alpha, 'targets': list(targets)}
+	if(hasattr(model.config, 'pack')):
+		config.update(pack=model.config.pack, pack_overlap=model.config.pack_overlap)
+	torch.save({'config': config, 'state_dict': state_dict}, path + ADAPTER_FILE)
+
+def has_adapter(path):
+	return os.path.exists(path + ADAPTER_FILE)
+
+def load_adapter(path, device=None):
+	return torch.load(path + ADAPTER_FILE, map_location=device)
@@ -1,20 +1,33 @@
 import os
+import io
 import re
 import json
 import glob
 import nltk
+import time
 import torch
+import itertools
 import spacy
+import fnmatch
 import string
+import tarfile
+import zipfile
 import argparse
 import nltk.data
+import multiprocessing
 import numpy as np
+from scipy import sparse
 from tqdm import tqdm
 from rouge import Rouge
+from collections import deque, Counter
 from utils.beam import *
+from utils.corpus import CorpusWriter, remove_corpus, load_raw
+from utils.device import get_device, to_device
+from utils.feature_store import save_sparse_split, SparseFeatureWriter, PackedTokenWriter, EmbeddingWriter
+from models.data_loader import get_indices, get_topic_labels, RegularDataset, TOPIC_INDEX_PATH
 from nltk.corpus import stopwords
 from sklearn.cluster import KMeans
-from transformers import BertTokenizer
+from transformers import BertTokenizer, BertTokenizerFast, BertModel
 from itertools import accumulate, permutations
 from sklearn.model_selection import train_test_split
 from sklearn.feature_extraction.text import CountVectorizer
@@ -28,6 +41,8 @@ sp = spacy.load('en_core_web_sm')
 word_tokenizer = nltk.word_tokenize
 sentence_tokenizer = nltk.sent_tokenize
 bert_tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
+# Rust-backed tokenizer with the same vocab, used for batched tokenization
+bert_tokenizer_fast = BertTokenizerFast.from_pretrained('bert-base-uncased', do_lower_case=True)
 
 # Load a single file
 def load_doc(filename):
@@ -60,35 +75,137 @@ def load_data(directory):
 			print(name)
 	return data, files
 
-# Creates 60/20/20 train/test/val split
-def create_test_train_val_split(bert_data, linear_data):
-	indices_train, indices_test = train_test_split(list(range(len(bert_data))), test_size=0.2)
+# Creates random 60/20/20 train/test/val split of document indices
+def get_test_train_val_indices(num_documents):
+	indices_train, indices_test = train_test_split(list(range(num_documents)), test_size=0.2)
 	indices_train, indices_val = train_test_split(indices_train, test_size=0.25)
+	return indices_train, indices_test, indices_val
 
-	bert_train = [bert_data[i] for i in indices_train]
-	bert_test = [bert_data[i] for i in indices_test]
-	bert_val = [bert_data[i] for i in indices_val]
-
-	linear_train = [linear_data[i] for i in indices_train]
-	linear_test = [linear_data[i] for i in indices_test]
-	linear_val = [linear_data[i] for i in indices_val]
-
-	return (bert_train, bert_test, bert_val), (linear_train, linear_test, linear_val), (indices_train, indices_test, indices_val)
-
-# Extract documents and summaries from .story files and writes them to json files in ../data/{dataset_name}/raw
-def jsonify(raw_path, dataset_name):
-	data, files = load_data(raw_path)
-	documents = [datum['document'] for datum in data]
-	summaries = [datum['summary'] for datum in data]
+# Load and split every file in a shard of filenames, skipping files that can't be decoded
+# Top-level so that it can be shipped to worker processes
+def load_shard(filenames):
+	data = list()
+	for filename in filenames:
+		try:
+			document, summary = split_doc(load_doc(filename))
+			data.append({'document':document, 'summary':summary})
+		except UnicodeDecodeError:
+			print(os.path.basename(filename))
+	return data
 
+# Decode, split and sentence tokenize every member in a shard of (name, bytes) pairs read from an archive
+def load_member_shard(members):
+	data = list()
+	for name, raw in members:
+		try:
+			# Decode the same way as load_doc (including newline translation) so output matches unpacked files
+			document, summary = split_doc(io.TextIOWrapper(io.BytesIO(raw), encoding='utf-8').read())
+			data.append({'document':document, 'summary':summary})
+		except UnicodeDecodeError:
+			print(name)
+	return data
+
+# Group an iterable into lists of shard_size items without materializing it
+def get_shards(items, shard_size):
+	items = iter(items)
+	while True:
+		shard = list(itertools.islice(items, shard_size))
+		if(not shard):
+			return
+		yield shard
+
+# Lazily list all files in directory whose names match pattern (all files if pattern is None)
+def iter_directory_files(directory, pattern=None):
+	with os.scandir(directory) as entries:
+		for entry in entries:
+			if(pattern is None or fnmatch.fnmatch(entry.name, pattern)):
+				yield directory + '/' + entry.name
+
+# Stream (name, bytes) for all regular files in a .tar(.gz)/.tgz or .zip archive whose names match pattern
+# Members are read in the order they are stored so the archive is read once, sequentially, and nothing is extracted
+def iter_archive_members(path, pattern=None):
+	if(zipfile.is_zipfile(path)):
+		with zipfile.ZipFile(path) as archive:
+			infos = [info for info in archive.infolist() if not info.is_dir()]
+			for info in sorted(infos, key=lambda info: info.header_offset):
+				if(pattern is None or fnmatch.fnmatch(info.filename, pattern)):
+					yield info.filename, archive.read(info)
+	else:
+		# 'r|*' opens the tar as a stream with transparent decompression, so no seeking back and forth
+		with tarfile.open(path, 'r|*') as archive:
+			for member in archive:
+				if(member.isfile() and (pattern is None or fnmatch.fnmatch(member.name, pattern))):
+					yield member.name, archive.extractfile(member).read()
+
+# Run load_fn over shards with a pool of workers, yielding the items of each result in input order
+# At most 2 * workers shards are in flight at once so memory stays bounded regardless of corpus size
+# initializer(*initargs) is run once in every worker (or once here if workers <= 1) before any shards are processed
+def iter_shard_results(shards, load_fn, workers=1, initializer=None, initargs=()):
+	if(workers <= 1):
+		if(initializer is not None):
+			initializer(*initargs)
+		for shard in shards:
+			yield from load_fn(shard)
+		return
+	with multiprocessing.Pool(workers, initializer, initargs) as pool:
+		pending = deque()
+		for shard in shards:
+			pending.append(pool.apply_async(load_fn, (shard,)))
+			if(len(pending) >= 2 * workers):
+				yield from pending.popleft().get()
+		while pending:
+			yield from pending.popleft().get()
+
+# Writes a json list one element at a time, producing the same output as json.dump on the whole list
+class JSONListWriter:
+	def __init__(self, path):
+		self.file = open(path, 'w')
+		self.file.write('[')
+		self.empty = True
+
+	def write(self, item):
+		if(not self.empty):
+			self.file.write(', ')
+		json.dump(item, self.file)
+		self.empty = False
+
+	def close(self):
+		self.file.write(']')
+		self.file.close()
+
+# Extract documents and summaries from .story files and writes them to ../data/{dataset_name}/raw
+# raw_path is either a directory of story files or a tar/zip archive containing them, pattern optionally filters files by name
+# Stories are split and sentence tokenized by worker processes in shards of shard_size files and streamed to disk in order
+# If corpus_format is jsonl, documents and summaries are written to sharded stores (see utils/corpus.py) in raw/documents/ and raw/summaries/
+# otherwise they are written to raw/documents.json and raw/summaries.json
+def jsonify(raw_path, dataset_name, workers=1, shard_size=256, pattern=None, corpus_format='jsonl', compression='gzip', records_per_shard=10000):
 	write_dir = '../data/{}/raw/'.format(dataset_name)
 	if not os.path.exists(write_dir):
 		os.makedirs(write_dir)
 
-	with open(write_dir + 'documents.json', 'w') as outfile:
-		json.dump(documents, outfile)
-	with open(write_dir + 'summaries.json', 'w') as outfile:
-		json.dump(summaries, outfile)
+	# Directories are read by the workers themselves, archives are read here in one pass and the contents handed to workers
+	if(os.path.isdir(raw_path)):
+		shards, load_fn = get_shards(iter_directory_files(raw_path, pattern), shard_size), load_shard
+	else:
+		shards, load_fn = get_shards(iter_archive_members(raw_path, pattern), shard_size), load_member_shard
+
+	# load_raw reads the sharded stores if there are any, so the other format left from an earlier run is removed
+	if(corpus_format == 'jsonl'):
+		for name in ('documents.json', 'summaries.json'):
+			if(os.path.exists(write_dir + name)):
+				os.remove(write_dir + name)
+		documents_writer = CorpusWriter(write_dir + 'documents', compression, records_per_shard)
+		summaries_writer = CorpusWriter(write_dir + 'summaries', compression, records_per_shard)
+	else:
+		remove_corpus(write_dir + 'documents')
+		remove_corpus(write_dir + 'summaries')
+		documents_writer = JSONListWriter(write_dir + 'documents.json')
+		summaries_writer = JSONListWriter(write_dir + 'summaries.json')
+	for datum in tqdm(iter_shard_results(shards, load_fn, workers)):
+		documents_writer.write(datum['document'])
+		summaries_writer.write(datum['summary'])
+	documents_writer.close()
+	summaries_writer.close()
 
 # Simple preprocessing - remove non alphanum/space and compress whitespace
 def preprocess_sentence(sentence):
@@ -119,7 +236,10 @@ def bucketize_sent_lens(number):
 	return out[::-1]
 	'''
 
-def get_linear_features(documents):
+# Get BoW, sentence length and position features for every sentence of every document
+# Returns a list with one feature matrix per document, a scipy CSR matrix if sparse is set, otherwise a dense tensor
+# The fitted vocabulary is written to vocabulary_path if it is given
+def get_linear_features(documents, sparse_features=True, vocabulary_path=None):
 	preprocessed_documents_flat, feat_pos, feat_len, doc_lens = [], [], [], []
 	doc_lens.append(0)
 
@@ -141,42 +261,161 @@ def get_linear_features(documents):
 							ngram_range=(1, 2))
 
 	# Get BoW features
-	feats_bow = vectorizer.fit_transform(preprocessed_documents_flat).toarray()
+	feats_bow = vectorizer.fit_transform(preprocessed_documents_flat)
+	if(vocabulary_path is not None):
+		vocabulary = vectorizer.get_feature_names_out().tolist()
+		document_frequencies = np.bincount(feats_bow.indices, minlength=len(vocabulary)).tolist()
+		save_vocabulary(vocabulary_path, vocabulary, document_frequencies, len(preprocessed_documents_flat))
 
 	# Adding features for sentence length and position
-	features = np.append(feats_bow, feat_len, axis=1)
+	splits = list(accumulate(doc_lens))
+	if(sparse_features):
+		# Keep everything sparse, the dense length/position columns are only 8 of the 10000+ columns
+		features = sparse.hstack([feats_bow, sparse.csr_matrix(feat_len), sparse.csr_matrix(feat_pos)], format='csr', dtype=np.float32)
+		return [features[splits[i]:splits[i+1]] for i in range(len(splits) - 1)]
+
+	features = np.append(feats_bow.toarray(), feat_len, axis=1)
 	features = np.append(features, feat_pos, axis=1)
 
 	# Separating into documents again for training
-	splits = list(accumulate(doc_lens))
 	features = [features[splits[i]:splits[i+1]] for i in range(len(splits) - 1)]
 	features = [torch.tensor(f) for f in features]
 
 	return features
 
-def tokenize_bert(documents):
-	tokenized_documents = []
-	for i, document in enumerate(documents):
-		tokenized_sentences = []
-		for sentence in document:
-			encoded_sent = bert_tokenizer.encode(
-				sentence,
-				add_special_tokens = True,
-				max_length = 512,
-				return_tensors = 'pt'
-			)[0]
-			tokenized_sentences.append(encoded_sent)
-		tokenized_documents.append(tokenized_sentences)
-	return tokenized_documents
+# Vectorized bucketize_sent_lens for an array of sentence lengths, returns a (len(numbers), 7) array
+def bucketize_sent_lens_array(numbers):
+	numbers = np.asarray(numbers, dtype=np.int64)
+	big = (numbers >= 64).astype(np.int64)
+	bits = (numbers[:, None] >> np.arange(5, -1, -1)) & 1
+	return np.column_stack([big, bits])
+
+def get_ngram_vectorizer(vocabulary=None):
+	return CountVectorizer(stop_words=stopwords.words('english'), ngram_range=(1, 2), vocabulary=vocabulary)
+
+# Pass 1 of chunked feature extraction: term and document frequencies of every n-gram in a chunk of (index, document) pairs
+# As in get_linear_features each sentence counts as a "document" for the vectorizer
+def count_chunk_ngrams(chunk):
+	sentences = [preprocess_sentence(sentence) for _, document in chunk for sentence in document]
+	vectorizer = get_ngram_vectorizer()
+	try:
+		counts = vectorizer.fit_transform(sentences)
+	except ValueError:
+		# Chunk has no n-grams left after stop word removal
+		return [(Counter(), Counter(), len(sentences))]
+	terms = vectorizer.get_feature_names_out()
+	tfs = np.asarray(counts.sum(axis=0)).ravel()
+	dfs = np.bincount(counts.indices, minlength=len(terms))
+	return [(Counter(dict(zip(terms, tfs.tolist()))), Counter(dict(zip(terms, dfs.tolist()))), len(sentences))]
+
+# Same vocabulary selection as CountVectorizer(max_features, min_df, max_df) fit on all sentences at once
+def select_vocabulary(tfs, dfs, num_sentences, max_features=10000, min_df=5, max_df=0.99):
+	terms = [term for term in dfs if dfs[term] >= min_df and dfs[term] <= max_df * num_sentences]
+	terms = sorted(terms, key=lambda term: -tfs[term])[:max_features]
+	return sorted(terms)
+
+# Set in every worker by init_chunk_vectorizer for pass 2
+chunk_vectorizer, chunk_num_documents = None, None
+
+def init_chunk_vectorizer(vocabulary, num_documents):
+	global chunk_vectorizer, chunk_num_documents
+	chunk_vectorizer = get_ngram_vectorizer(vocabulary)
+	chunk_num_documents = num_documents
+
+# Pass 2 of chunked feature extraction: sparse BoW, length and position features for a chunk of (index, document) pairs
+def transform_chunk(chunk):
+	sentences = [sentence for _, document in chunk for sentence in document]
+	if(not sentences):
+		return [sparse.csr_matrix((0, len(chunk_vectorizer.vocabulary) + 8), dtype=np.float32) for _ in chunk]
+	feats_bow = chunk_vectorizer.transform([preprocess_sentence(sentence) for sentence in sentences])
+	# Lengths are still counted with word_tokenizer one sentence at a time, as in get_linear_features: the bucketized
+	# bits change with any difference in counting, and word_tokenizer run over a whole chunk splits sentences differently
+	# Only the bucketizing is vectorized, the speedup of chunking comes from the workers and the bounded memory
+	feat_len = bucketize_sent_lens_array([len(word_tokenizer(sentence)) for sentence in sentences])
+	# Position feature is the same as in get_linear_features
+	feat_pos = np.concatenate([np.full(len(document), (i+1)/chunk_num_documents) for i, document in chunk])[:, None]
+	features = sparse.hstack([feats_bow, sparse.csr_matrix(feat_len), sparse.csr_matrix(feat_pos)], format='csr', dtype=np.float32)
+	splits = [0] + list(accumulate(len(document) for _, document in chunk))
+	return [features[splits[i]:splits[i+1]] for i in range(len(chunk))]
+
+# Out-of-core version of get_linear_features that never holds more than a few chunks of text and features in memory
+# Pass 1 streams chunks of chunk_size documents to build the vocabulary and document frequencies, pass 2 transforms the
+# chunks and yields the sparse feature matrix of every document in order, for the caller to write out as it goes
+# Both passes run over a pool of workers, and the fitted vocabulary is written to vocabulary_path if it is given
+def iter_linear_features_chunked(documents, chunk_size, workers=1, vocabulary_path=None):
+	tfs, dfs, num_sentences = Counter(), Counter(), 0
+	chunks = get_shards(enumerate(documents), chunk_size)
+	for chunk_tfs, chunk_dfs, chunk_num_sentences in tqdm(iter_shard_results(chunks, count_chunk_ngrams, workers)):
+		tfs.update(chunk_tfs)
+		dfs.update(chunk_dfs)
+		num_sentences += chunk_num_sentences
+	vocabulary = select_vocabulary(tfs, dfs, num_sentences)
+	if(vocabulary_path is not None):
+		save_vocabulary(vocabulary_path, vocabulary, [dfs[term] for term in vocabulary], num_sentences)
+	del tfs, dfs
+
+	chunks = get_shards(enumerate(documents), chunk_size)
+	yield from tqdm(iter_shard_results(chunks, transform_chunk, workers, init_chunk_vectorizer, (vocabulary, len(documents))), total=len(documents))
+
+# Write the fitted n-gram vocabulary (in feature column order) and the document frequency of each term
+def save_vocabulary(path, vocabulary, document_frequencies, num_sentences):
+	with open(path, 'w') as outfile:
+		json.dump({'vocabulary': vocabulary, 'document_frequencies': document_frequencies, 'num_sentences': num_sentences}, outfile)
+
+# Tokenize a batch of documents with the fast tokenizer in a single call over all of their sentences
+# Returns plain lists of token ids per sentence per document so results are cheap to send back from workers
+def tokenize_bert_batch(documents):
+	sentences = [sentence for document in documents for sentence in document]
+	# Same settings as the per-sentence encode in tokenize_bert, which truncates to max_length
+	encoded = bert_tokenizer_fast(sentences, add_special_tokens=True, max_length=512, truncation=True)['input_ids']
+	splits = [0] + list(accumulate(len(document) for document in documents))
+	return [encoded[splits[i]:splits[i+1]] for i in range(len(documents))]
+
+# Tokenize documents, yielding a list of token ids for every sentence of each document in order
+# The fast tokenizer encodes batch_size documents per call, optionally spread over a pool of workers
+# The slow tokenizer encodes one sentence at a time and is kept for comparison
+def iter_tokenize_bert(documents, tokenizer='fast', batch_size=64, workers=1):
+	t0 = time.time()
+	num_sentences = 0
+	if(tokenizer == 'fast'):
+		if(workers > 1):
+			# Each worker runs its own single threaded tokenizer, avoids deadlocks from forking a threaded tokenizer
+			os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+		shards = get_shards(documents, batch_size)
+		for tokenized_sentences in tqdm(iter_shard_results(shards, tokenize_bert_batch, workers), total=len(documents)):
+			num_sentences += len(tokenized_sentences)
+			yield tokenized_sentences
+	else:
+		for i, document in enumerate(tqdm(documents)):
+			tokenized_sentences = []
+			for sentence in document:
+				encoded_sent = bert_tokenizer.encode(
+					sentence,
+					add_special_tokens = True,
+					max_length = 512
+				)
+				tokenized_sentences.append(encoded_sent)
+			num_sentences += len(tokenized_sentences)
+			yield tokenized_sentences
+	elapsed = time.time() - t0
+	print('Tokenized {} sentences in {:.1f}s ({:.1f} sentences/s) with the {} tokenizer'.format(num_sentences, elapsed, num_sentences / max(elapsed, 1e-9), tokenizer))
+
+# Tokenize documents into lists of token id tensors, one per sentence
+def tokenize_bert(documents, tokenizer='fast', batch_size=64, workers=1):
+	return [[torch.tensor(ids) for ids in tokenized_sentences] for tokenized_sentences in iter_tokenize_bert(documents, tokenizer, batch_size, workers)]
 
 # Extract linear features and create BERT tokens for dataset and write them to ../data/{dataset_name}/linear/ and ../data/{dataset_name}/bert/
 # Also creates train test val split - if overwrite is set and split already exists, then it is overwritten
-def bert_tokens_and_linear_features(dataset_name, overwrite):
+# If linear_format is sparse, linear features for each split are written as a single CSR matrix (see utils/feature_store.py)
+# otherwise as one dense tensor per document
+# If chunk_size is set, linear features are extracted out-of-core in chunks of chunk_size documents (see iter_linear_features_chunked)
+# The fitted vocabulary is saved to ../data/{dataset_name}/linear/vocabulary.json
+# If bert_format is packed, BERT tokens are streamed into a packed, memory-mappable token store per split (see utils/feature_store.py)
+# otherwise they are written as one .pt file per document
+def bert_tokens_and_linear_features(dataset_name, overwrite, tokenizer='fast', tokenize_batch_size=64, workers=1, linear_format='sparse', chunk_size=0, bert_format='packed'):
 	folders = ['linear/', 'bert/']
 	subfolders = ['train/', 'test/', 'val/']
-	json_path = '../data/{}/raw/documents.json'.format(dataset_name)
-	with open(json_path) as json_file:
-		documents = json.load(json_file)
+	documents = load_raw(dataset_name, 'documents')
 
 	# Create all output dirs, if features/tokens already exist and overwrite is false then abort
 	dataset_path = '../data/{}/'.format(dataset_name)
@@ -192,24 +431,129 @@ def bert_tokens_and_linear_features(dataset_name, overwrite):
 			for file in files:
 				os.remove(file)
 
-	# Get features/tokens
-	bert_tokens = tokenize_bert(documents)
-	linear_features = get_linear_features(documents)
+	# A new split invalidates the topic index, it is rebuilt by topic_clustering, and sentence embeddings
+	for file in glob.glob(TOPIC_INDEX_PATH.format(dataset_name, '*')) + glob.glob(dataset_path + 'embedding/*/*'):
+		os.remove(file)
 
 	# Create train/test/val split
-	bert_data, linear_data, indices = create_test_train_val_split(bert_tokens, linear_features)
+	indices = get_test_train_val_indices(len(documents))
+
+	split_of = {}
+	for subfolder, subindices in zip(subfolders, indices):
+		split_of.update((index, subfolder) for index in subindices)
+
+	# Get tokens, packed tokens are written out as they are produced so they never all have to be in memory
+	if(bert_format == 'packed'):
+		writers = {subfolder : PackedTokenWriter(dataset_path + 'bert/' + subfolder, len(bert_tokenizer_fast)) for subfolder in subfolders}
+		for index, tokenized_sentences in enumerate(iter_tokenize_bert(documents, tokenizer, tokenize_batch_size, workers)):
+			writers[split_of[index]].write(index, tokenized_sentences)
+		for writer in writers.values():
+			writer.close()
+	else:
+		bert_tokens = tokenize_bert(documents, tokenizer, tokenize_batch_size, workers)
+
+	# Get features, chunked features are written out chunk by chunk as they are produced so memory stays flat
+	vocabulary_path = dataset_path + 'linear/vocabulary.json'
+	if(chunk_size > 0):
+		writers = {}
+		for index, features in enumerate(iter_linear_features_chunked(documents, chunk_size, workers, vocabulary_path)):
+			subfolder = split_of[index]
+			if(linear_format != 'sparse'):
+				torch.save(torch.tensor(features.toarray(), dtype=torch.float64), dataset_path + 'linear/' + subfolder + str(index) + '.pt')
+				continue
+			if(subfolder not in writers):
+				writers[subfolder] = SparseFeatureWriter(dataset_path + 'linear/' + subfolder, features.shape[1])
+			writers[subfolder].write(index, features)
+		for writer in writers.values():
+			writer.close()
+		linear_features = None
+	else:
+		linear_features = get_linear_features(documents, linear_format == 'sparse', vocabulary_path)
 
 	# Write everything out
-	for subfolder, subindices, linear_sub, bert_sub in list(zip(subfolders, indices, linear_data, bert_data)):
-		for i, index in enumerate(subindices):
-			torch.save(linear_sub[i], dataset_path + 'linear/' + subfolder + str(index) + '.pt')
-			torch.save(bert_sub[i], dataset_path + 'bert/' + subfolder + str(index) + '.pt')
+	for subfolder, subindices in zip(subfolders, indices):
+		if(linear_features is not None and linear_format == 'sparse'):
+			save_sparse_split(dataset_path + 'linear/' + subfolder, [linear_features[index] for index in subindices], subindices)
+		for index in subindices:
+			if(linear_features is not None and linear_format != 'sparse'):
+				torch.save(linear_features[index], dataset_path + 'linear/' + subfolder + str(index) + '.pt')
+			if(bert_format != 'packed'):
+				torch.save(bert_tokens[index], dataset_path + 'bert/' + subfolder + str(index) + '.pt')
 
 	# Write the train/test/split to a file for later use
 	# with open(dataset_path + 'train_test_split.txt', 'w') as outfile:
 	# 	train_indices, test_indices, val_indices = indices
 	# 	outfile.write(str(train_indices) + '\n' + str(test_indices) + '\n' + str(val_indices))
 
+# Embed sentences (lists of token ids) with a frozen BERT encoder, pooling its last layer with the [CLS] token (cls)
+# or the mean over tokens (mean), in batches of batch_size sentences of similar length
+def embed_sentences(encoder, sentences, pooling, batch_size, device):
+	order = np.argsort([len(sentence) for sentence in sentences], kind='stable')
+	embeddings = np.zeros((len(sentences), encoder.config.hidden_size), dtype=np.float16)
+	for start in range(0, len(order), batch_size):
+		batch = order[start:start+batch_size]
+		max_len = max(len(sentences[i]) for i in batch)
+		input_ids = np.zeros((len(batch), max_len), dtype=np.int64)
+		attention_mask = np.zeros((len(batch), max_len), dtype=np.int64)
+		for row, i in enumerate(batch):
+			input_ids[row, :len(sentences[i])] = sentences[i]
+			attention_mask[row, :len(sentences[i])] = 1
+		input_ids, attention_mask = to_device((torch.from_numpy(input_ids), torch.from_numpy(attention_mask)), device)
+		with torch.no_grad():
+			hidden_states = encoder(input_ids, attention_mask=attention_mask)[0]
+		if(pooling == 'cls'):
+			pooled = hidden_states[:, 0]
+		else:
+			mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+			pooled = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+		embeddings[batch] = pooled.cpu().numpy()
+	return embeddings
+
+# Run a frozen BERT encoder once over the BERT tokens of every split and cache a float16 embedding per sentence in
+# ../data/{dataset_name}/embedding/{split}/ (see utils/feature_store.py), rows follow the order of the split's tokens
+# encoder is bert-base-uncased or the path of a saved (e.g. fine-tuned) BERT model, sentences are embedded pool_size
+# batches at a time, sorted by length so batches need little padding
+def bert_embeddings(dataset_name, overwrite, encoder='bert-base-uncased', pooling='cls', batch_size=64, device='auto', pool_size=50):
+	device = get_device(device)
+	dataset_path = '../data/{}/'.format(dataset_name)
+	subfolders = ['train/', 'test/', 'val/']
+
+	for subfolder in subfolders:
+		path = dataset_path + 'embedding/' + subfolder
+		if not os.path.exists(path):
+			os.makedirs(path)
+		files = glob.glob(path + '*')
+		if(not overwrite and files):
+			print('Sentence embeddings for this dataset have already been cached. If you would like to overwrite them, please run again with the -overwrite flag.')
+			return
+		for file in files:
+			os.remove(file)
+
+	model = BertModel.from_pretrained(encoder).to(device)
+	model.eval()
+
+	for subfolder in subfolders:
+		t0 = time.time()
+		path = dataset_path + 'embedding/' + subfolder
+		doc_ids = get_indices(dataset_name, 'bert', subfolder[:-1])
+		dataset = RegularDataset(dataset_name, doc_ids, [0] * len(doc_ids), subfolder[:-1], 'bert')
+		documents = (dataset.load_features(index) for index in doc_ids)
+		sent_counts = dataset.doc_lengths()[0]
+		doc_offsets = np.concatenate([[0], np.cumsum(sent_counts)])
+
+		writer = EmbeddingWriter(path, int(doc_offsets[-1]), model.config.hidden_size)
+		# Documents are read one at a time and their sentences embedded once pool_size batches' worth have been read
+		pool, start = [], 0
+		for i, document in enumerate(documents):
+			pool.extend(document)
+			if(len(pool) >= batch_size * pool_size or i == len(doc_ids) - 1):
+				writer.write(slice(start, start + len(pool)), embed_sentences(model, pool, pooling, batch_size, device))
+				pool, start = [], start + len(pool)
+		writer.close(doc_offsets, doc_ids, {'encoder': encoder, 'pooling': pooling, 'num_sentences': int(doc_offsets[-1]), 'dim': model.config.hidden_size})
+
+		elapsed = time.time() - t0
+		print('Embedded {} sentences of the {} split in {:.1f}s ({:.1f} sentences/s)'.format(doc_offsets[-1], subfolder[:-1], elapsed, doc_offsets[-1] / max(elapsed, 1e-9)))
+
 def get_rouge(hypothesis, reference, rougetype, scoretype):
 	return rouge.get_scores(hypothesis, reference)[0][rougetype][scoretype]
 
@@ -217,7 +561,7 @@ def get_rouge(hypothesis, reference, rougetype, scoretype):
 # TODO: Configurability for whether to allow repeat sentences, currently set to DON'T
 def get_vanilla_oracles(documents, summaries):
 	oracles = []
-	for document, summary in tqdm(list(zip(documents, summaries))):
+	for document, summary in tqdm(zip(documents, summaries), total=len(documents)):
 		document_sentences = [' '.join([word.lemma_ for word in sp(sentence)]) for sentence in document]
 		summary_sentences = [' '.join([word.lemma_ for word in sp(sentence)]) for sentence in summary]
 		oracle = []
@@ -236,7 +580,7 @@ def get_vanilla_oracles(documents, summaries):
 # Try all permutations for oracle indices to see which maximizes pairwise ROUGE with summary sentences
 def optimize_beam_oracles(documents, summaries, oracles):
 	optimized_oracles = []
-	for document, summary, oracle_indices in tqdm(list(zip(documents, summaries, oracles))):
+	for document, summary, oracle_indices in tqdm(zip(documents, summaries, oracles), total=len(documents)):
 		try:
 			best_option = oracle_indices
 			if(len(oracle_indices) <= 9):
@@ -256,7 +600,7 @@ def optimize_beam_oracles(documents, summaries, oracles):
 # TODO: Configurability for whether to allow repeat sentences
 def get_beam_oracles(documents, summaries):
 	oracles = []
-	for document, summary in tqdm(list(zip(documents, summaries))):
+	for document, summary in tqdm(zip(documents, summaries), total=len(documents)):
 		document = [' '.join([word.lemma_ for word in sp(sentence)]) for sentence in document]
 		summary = [' '.join([word.lemma_ for word in sp(sentence)]) for sentence in summary]
 		beam = Beam(15)
@@ -281,10 +625,8 @@ def get_beam_oracles(documents, summaries):
 # Construct oracle extractive summaries and save them to ../data/{dataset_name}/raw/oracles.json
 def construct_oracles(dataset_name, vanilla_oracles):
 	json_path = '../data/{}/raw/'.format(dataset_name)
-	with open(json_path + 'documents.json') as json_file:
-		documents = json.load(json_file)
-	with open(json_path + 'summaries.json') as json_file:
-		summaries = json.load(json_file)
+	documents = load_raw(dataset_name, 'documents')
+	summaries = load_raw(dataset_name, 'summaries')
 
 	if(vanilla_oracles):
 		oracles = get_vanilla_oracles(documents, summaries)
@@ -295,11 +637,13 @@ def construct_oracles(dataset_name, vanilla_oracles):
 	with open(json_path + 'oracles.json', 'w') as outfile:
 		json.dump(oracles, outfile)
 
+	# Labels in the topic index come from the oracles, so refresh it if topics have already been clustered
+	if(os.path.exists(json_path + 'topics.json')):
+		write_topic_index(dataset_name)
+
 # Perform clustering to get topic representations and save them to ../data/{dataset_name}/raw/topics.json
 def get_topic_representations(dataset_name):
-	json_path = '../data/{}/raw/summaries.json'.format(dataset_name)
-	with open(json_path) as json_file:
-		summaries = json.load(json_file)
+	summaries = load_raw(dataset_name, 'summaries')
 
 	# "Flatten" summaries
 	summaries_flat = []
@@ -358,6 +702,33 @@ def get_topic_representations(dataset_name):
 	with open(write_dir + 'topics.json', 'w') as outfile:
 		json.dump(topic_representations, outfile)
 
+	write_topic_index(dataset_name)
+
+# Write an index of each split's documents and their oracle label for every topic to ../data/{dataset_name}/index/{split}.npz
+# doc_ids holds the documents of the split and labels[i][t] the oracle sentence for the first summary sentence of topic t
+# in document doc_ids[i], or -1 if its summary has no sentence of topic t, so loaders don't have to scan the json files
+# The index is skipped, with a note, until features have been extracted (the splits exist) and oracles constructed
+def write_topic_index(dataset_name):
+	json_path = '../data/{}/raw/'.format(dataset_name)
+	paths = [json_path + 'oracles.json', json_path + 'topics.json']
+	paths += ['../data/{}/linear/{}/'.format(dataset_name, dataset_type) for dataset_type in ['train', 'test', 'val']]
+	missing = [path for path in paths if not os.path.exists(path)]
+	if(missing):
+		print('Not writing the topic index, {} missing. Run -mode topic_index once features and oracles exist'.format(', '.join(missing)))
+		return
+	with open(json_path + 'oracles.json') as json_file:
+		oracles = json.load(json_file)
+	with open(json_path + 'topics.json') as json_file:
+		topic_representations = json.load(json_file)
+	labels = get_topic_labels(topic_representations, oracles)
+
+	for dataset_type in ['train', 'test', 'val']:
+		path = TOPIC_INDEX_PATH.format(dataset_name, dataset_type)
+		if not os.path.exists(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		doc_ids = np.array(get_indices(dataset_name, 'linear', dataset_type), dtype=np.int64)
+		np.savez(path, doc_ids=doc_ids, labels=labels[doc_ids])
+
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-raw_path', default='')
@@ -367,16 +738,47 @@ if __name__ == '__main__':
 	parser.add_argument('-overwrite', action='store_true', default=False)
 	# Construct oracles by optimizing for individual sentences rather than the entire summary
 	parser.add_argument('-vanilla_oracles', action='store_true', default=False)
+	# Number of worker processes used to split and tokenize stories and to tokenize sentences for BERT (1 means everything runs in this process)
+	parser.add_argument('-workers', type=int, default=1)
+	# Number of story files handed to a worker at a time
+	parser.add_argument('-shard_size', type=int, default=256)
+	# Only jsonify story files whose name (path inside the archive for archives) matches this glob e.g. '*.story'
+	parser.add_argument('-pattern', default=None)
+	# Write raw documents/summaries as sharded, line-delimited stores (jsonl) or as single json files (json)
+	parser.add_argument('-corpus_format', default='jsonl', choices=['jsonl', 'json'])
+	# Compression for jsonl shards, zstd requires the zstandard package
+	parser.add_argument('-compression', default='gzip', choices=['gzip', 'zstd', 'none'])
+	parser.add_argument('-records_per_shard', type=int, default=10000)
+	# Tokenizer used for BERT tokens - fast (batched, Rust-backed) or slow (one sentence at a time)
+	parser.add_argument('-tokenizer', default='fast', choices=['fast', 'slow'])
+	# Number of documents tokenized per call to the fast tokenizer
+	parser.add_argument('-tokenize_batch_size', type=int, default=64)
+	# Store linear features as one sparse CSR matrix per split (sparse) or as a dense tensor per document (dense)
+	parser.add_argument('-linear_format', default='sparse', choices=['sparse', 'dense'])
+	# If set, extract linear features in two streaming passes over chunks of this many documents instead of all at once
+	parser.add_argument('-chunk_size', type=int, default=0)
+	# Store BERT tokens for each split in a packed, memory-mapped token store (packed) or as a .pt file per document (pt)
+	parser.add_argument('-bert_format', default='packed', choices=['packed', 'pt'])
+	# Encoder (bert-base-uncased or the path of a saved BERT model) and pooling used to cache sentence embeddings,
+	# how many sentences are embedded at once and on what device
+	parser.add_argument('-encoder', default='bert-base-uncased')
+	parser.add_argument('-pooling', default='cls', choices=['cls', 'mean'])
+	parser.add_argument('-embed_batch_size', type=int, default=64)
+	parser.add_argument('-device', default='auto')
 	args = parser.parse_args()
 
-	raw_path, dataset_name, mode, overwrite, vanilla_oracles =\
-		args.raw_path, args.dataset_name, args.mode, args.overwrite, args.vanilla_oracles
+	raw_path, dataset_name, mode, overwrite, vanilla_oracles, workers, shard_size, pattern =\
+		args.raw_path, args.dataset_name, args.mode, args.overwrite, args.vanilla_oracles, args.workers, args.shard_size, args.pattern
 
 	if(args.mode == 'jsonify'):
-		jsonify(raw_path, dataset_name)
+		jsonify(raw_path, dataset_name, workers, shard_size, pattern, args.corpus_format, args.compression, args.records_per_shard)
 	elif(args.mode == 'construct_oracles'):
 		construct_oracles(dataset_name, vanilla_oracles)
 	elif(args.mode == 'topic_clustering'):
 		get_topic_representations(dataset_name)
+	elif(args.mode == 'topic_index'):
+		write_topic_index(dataset_name)
 	elif(args.mode == 'bert_tokens_and_linear_features'):
-		bert_tokens_and_linear_features(dataset_name, overwrite)
+		bert_tokens_and_linear_features(dataset_name, overwrite, args.tokenizer, args.tokenize_batch_size, workers, args.linear_format, args.chunk_size, args.bert_format)
+	elif(args.mode == 'bert_embeddings'):
+		bert_embeddings(dataset_name, overwrite, args.encoder, args.pooling, args.embed_batch_size, args.device)
@@ -4,15 +4,27 @@ import os
 import time
 import datetime
 import argparse
+import functools
+import multiprocessing
 from torch import nn, optim
 from models.linear import *
+from models.lora import add_lora, save_adapter, has_adapter, ADAPTER_FILE
+from models.bert import score_documents
 from utils.earlystopping import *
+from utils.checkpoint import CheckpointWriter, load_checkpoint, get_rng_state, set_rng_state
+from utils.device import get_device, to_device, peak_memory, reset_peak_memory
 from models.data_loader import *
 from transformers import get_linear_schedule_with_warmup
 from transformers import BertForSequenceClassification, AdamW, BertConfig
 
 # Patience is the number of consecutive iterations with no improvement in validation loss before training is aborted
-def train_linear(train_loader, valid_loader, n_epochs, batch_size, topic, patience=7):
+# If topic is 'all', a single model scores sentences for every topic (loaders then hold label vectors, -1 where a
+# document's summary has no sentence of a topic, which are left out of the loss) and is saved as one .th file per topic
+# Sentence embedding models (model type embedding) are trained the same way, on the cached embeddings instead of linear features
+# If hidden is set, the model has a hidden layer of that size (see LinearModel)
+# The best model is kept in memory, if checkpoint_interval is set it is also written to disk every checkpoint_interval seconds
+def train_linear(train_loader, valid_loader, n_epochs, batch_size, topic, patience=7, device=None, hidden=None, checkpoint_interval=None):
+	device = get_device() if device is None else device
 	print ('[I] Start training')
 	"""
 	Load the training data
@@ -27,14 +39,19 @@ def train_linear(train_loader, valid_loader, n_epochs, batch_size, topic, patien
 	# to track the average validation loss per epoch as the model trains
 	avg_valid_losses = []
 
-	# Get number of features
+	# Get number of features and topics
 	for inputs, mask, targets in train_loader:
-		num_features = inputs[0].shape[1]
+		num_features = inputs.shape[-1]
+		num_topics = targets.shape[-1]
 		break
 
-	loss = nn.NLLLoss()
-	model = LinearModel(num_features).cuda()
-	early_stopping = EarlyStopping(train_loader.dataset.dataset_name, patience=patience, verbose=True)
+	model_type = train_loader.dataset.model_type
+	save_path = '../models/{}/{}'.format(train_loader.dataset.dataset_name, model_type)
+	loss = nn.NLLLoss(ignore_index=-1)
+	model = LinearModel(num_features, hidden or 512, num_topics, hidden is not None).to(device)
+	# Each topic and run has its own checkpoint so that topics can be trained at the same time
+	early_stopping = EarlyStopping(train_loader.dataset.dataset_name, patience=patience, verbose=True, model_type=model_type,
+		path='{}/checkpoint_{}_{}.pt'.format(save_path, topic, os.getpid()), save_interval=checkpoint_interval)
 
 	optimizer = optim.Adam(model.parameters(), lr = 1e-2)
 	# optimizer = optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
@@ -45,6 +62,7 @@ def train_linear(train_loader, valid_loader, n_epochs, batch_size, topic, patien
 
 		# Get batches from training dataloader
 		for batch, (inputs, mask, targets) in enumerate(train_loader):
+			inputs, mask, targets = to_device((inputs, mask, targets), device)
 			optimizer.zero_grad()
 			scores, preds = model(inputs, mask)
 			train_loss = loss(scores, targets)
@@ -56,6 +74,7 @@ def train_linear(train_loader, valid_loader, n_epochs, batch_size, topic, patien
 
 		# Get batches from validation dataloader
 		for inputs, mask, targets in valid_loader:
+			inputs, mask, targets = to_device((inputs, mask, targets), device)
 			scores, preds = model(inputs, mask)
 			valid_loss = loss(scores, targets)
 			valid_losses.append(valid_loss.item())
@@ -89,18 +108,109 @@ def train_linear(train_loader, valid_loader, n_epochs, batch_size, topic, patien
 
 	print ('[I] Training finished')
 
-	save_path = '../models/{}/linear'.format(train_loader.dataset.dataset_name)
-
-	# Load last checkpoint and save it
-	model.load_state_dict(torch.load('{}/checkpoint.pt'.format(save_path)))
-
-	print("Saving model to %s" % '{}/{}.th'.format(save_path, topic))
-	torch.save(model.state_dict(), '{}/{}.th'.format(save_path, topic))
+	# Load best model and save it
+	early_stopping.load_best(model)
+
+	save_linear_model(model, save_path, topic)
+	early_stopping.close()
+
+	best_epoch = int(np.argmin(avg_valid_losses))
+	return {'epochs': len(avg_valid_losses), 'train_loss': float(avg_train_losses[best_epoch]), 'valid_loss': float(avg_valid_losses[best_epoch])}
+
+# Save a linear model as {topic}.th in save_path, or as one file per topic if it was trained for all topics
+def save_linear_model(model, save_path, topic):
+	if(topic == 'all'):
+		for topic in range(model.linear.out_features):
+			print("Saving model to %s" % '{}/{}.th'.format(save_path, topic))
+			torch.save(model.topic_state_dict(topic), '{}/{}.th'.format(save_path, topic))
+	else:
+		print("Saving model to %s" % '{}/{}.th'.format(save_path, topic))
+		torch.save(model.state_dict(), '{}/{}.th'.format(save_path, topic))
+
+# Full-batch alternative to train_linear: minimizes the training loss over all training documents plus l2 times the
+# squared norm of the weights with L-BFGS, which for a linear model is a convex problem solved in a few dozen passes
+# Batches are collated once, in a fixed order, and kept in memory, so results are deterministic
+# n_epochs is the maximum number of L-BFGS iterations, the model is saved like train_linear's
+def train_linear_lbfgs(train_loader, valid_loader, n_epochs, batch_size, topic, device=None, l2=1e-4):
+	device = get_device() if device is None else device
+	print ('[I] Start training')
 
+	# Collate every split once, documents sorted by id
+	def get_batches(loader):
+		indices = sorted(loader.dataset.labels)
+		return [to_device(loader.collate_fn([loader.dataset[index] for index in indices[i:i+batch_size]]), device) for i in range(0, len(indices), batch_size)]
+	train_batches, valid_batches = get_batches(train_loader), get_batches(valid_loader)
+
+	num_features, num_topics = train_batches[0][0].shape[-1], train_batches[0][2].shape[-1]
+	model = LinearModel(num_features, num_topics=num_topics).to(device)
+	loss = nn.NLLLoss(reduction='sum', ignore_index=-1)
+
+	# Mean loss over all labelled (document, topic) pairs of batches
+	def get_loss(batches):
+		total = sum(loss(model(inputs, mask)[0], targets) for inputs, mask, targets in batches)
+		return total / sum((targets >= 0).sum() for inputs, mask, targets in batches)
+
+	optimizer = optim.LBFGS(model.parameters(), lr=1, max_iter=n_epochs, history_size=20, line_search_fn='strong_wolfe')
+	passes = []
+	def closure():
+		optimizer.zero_grad()
+		train_loss = get_loss(train_batches) + l2 * model.linear.weight.pow(2).sum()
+		train_loss.backward()
+		passes.append(train_loss.item())
+		return train_loss
+
+	t0 = time.time()
+	optimizer.step(closure)
+	with torch.no_grad():
+		valid_loss = get_loss(valid_batches).item()
+	print('[I] Training finished after {} passes in {:.1f}s, train_loss: {:.5f} valid_loss: {:.5f}'.format(len(passes), time.time() - t0, passes[-1], valid_loss))
+
+	save_linear_model(model, '../models/{}/{}'.format(train_loader.dataset.dataset_name, train_loader.dataset.model_type), topic)
+
+	return {'passes': len(passes), 'train_loss': passes[-1], 'valid_loss': valid_loss}
+
+# Topics without a label (-1) are left out
+# preds holds the scores of a batch of documents, (batch_size, max_doc_len, num_topics)
 def flat_accuracy(preds, labels):
-	pred_flat = np.argmax(preds, axis=0).flatten()
+	pred_flat = np.argmax(preds, axis=1).flatten()
 	labels_flat = labels.flatten()
-	return np.sum(pred_flat == labels_flat) / len(labels_flat)
+	keep = labels_flat >= 0
+	return np.sum(pred_flat[keep] == labels_flat[keep]) / max(np.sum(keep), 1)
+
+# File in the model directory the state of BERT training is saved to, see train_bert
+TRAINING_STATE_FILE = 'training_state.pt'
+
+# Autocast data type of each precision BERT can be trained in
+BERT_PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+# Forward and backward pass of a BERT batch, run in precision (with autocast unless it is fp32), with the loss divided
+# by accumulation_steps so that the gradients summed over that many batches are the gradients of their mean loss
+# scaler is the GradScaler of fp16 training, None otherwise
+# Returns the loss of the batch
+def bert_backward(model, batch, criterion, device, precision='fp32', scaler=None, accumulation_steps=1):
+	b_labels = to_device(batch[2], device)
+	with torch.autocast(device.type, dtype=BERT_PRECISIONS[precision], enabled=precision != 'fp32'):
+		scores = score_documents(model, batch, device)
+	# The loss is computed in fp32 whatever the precision of the scores
+	loss = criterion(scores.float(), b_labels)
+	scaled_loss = loss / accumulation_steps
+	if(scaler is not None):
+		scaled_loss = scaler.scale(scaled_loss)
+	scaled_loss.backward()
+	return loss
+
+# Clip the accumulated gradients of parameters to a norm of 1.0, update them and the learning rate, and clear the gradients
+def bert_optimizer_step(parameters, optimizer, scheduler, scaler=None):
+	if(scaler is not None):
+		scaler.unscale_(optimizer)
+	torch.nn.utils.clip_grad_norm_(parameters, 1.0)
+	if(scaler is not None):
+		scaler.step(optimizer)
+		scaler.update()
+	else:
+		optimizer.step()
+	scheduler.step()
+	optimizer.zero_grad()
 
 def format_time(elapsed):
 	'''
@@ -111,36 +221,112 @@ def format_time(elapsed):
 	# Format as hh:mm:ss
 	return str(datetime.timedelta(seconds=elapsed_rounded))
 
-def train_bert(train_loader, valid_loader, n_epochs, batch_size, topic):
-	device = torch.device("cuda")
+# If topic is 'all', a single BERT encoder is trained with one output (scoring head) per topic, on loaders holding
+# label vectors as in train_linear, and saved to ../models/{dataset_name}/multi_bert/
+# If lora_rank is set, BERT is frozen and only low-rank adapters of that rank and the classification head are trained
+# and saved (see models/lora.py), which needs a fraction of the optimizer memory and disk space
+# The model of the epoch with the lowest validation loss is saved, training stops early after patience epochs without
+# improvement if patience is set, and the best model is written to disk every checkpoint_interval seconds if that is set
+# precision is fp32, bf16 or fp16 (autocast, fp16 also scales the loss and needs a GPU), gradients are accumulated over
+# accumulation_steps batches per optimizer step, and if gradient_checkpointing is set the activations of encoder layers
+# are recomputed in the backward pass instead of kept, which trades compute for memory on long documents
+# If state_interval is set, the training state (model, optimizer, scheduler, random number generators, position in the
+# epoch and order of its batches) is written to training_state.pt in the model directory every state_interval seconds
+# and after every epoch, in the background. If resume is set, training continues from that state where it stopped
+def train_bert(train_loader, valid_loader, n_epochs, batch_size, topic, device=None, lora_rank=None, lora_alpha=16, patience=None, checkpoint_interval=None,
+	precision='fp32', accumulation_steps=1, gradient_checkpointing=False, state_interval=None, resume=False, pack=False, pack_overlap=2):
+	device = get_device() if device is None else device
+
+	if(topic == 'all'):
+		save_path = '../models/{}/multi_bert/'.format(train_loader.dataset.dataset_name)
+	else:
+		save_path = '../models/{}/bert/{}/'.format(train_loader.dataset.dataset_name, topic)
+
+	if not os.path.exists(save_path):
+		os.makedirs(save_path)
+
+	# Training state to resume from, if there is one
+	state = load_checkpoint(save_path + TRAINING_STATE_FILE) if resume else None
+	if(state is not None and state['done']):
+		print('Training of the model in {} was already completed'.format(save_path))
+		return state['results']
+	state_writer = CheckpointWriter(save_path + TRAINING_STATE_FILE) if state_interval is not None else None
 
-	criterion = nn.CrossEntropyLoss()
+	# Get number of topics
+	for batch in train_loader:
+		num_topics = batch[2].shape[-1]
+		break
+
+	criterion = nn.CrossEntropyLoss(ignore_index=-1)
 
 	model = BertForSequenceClassification.from_pretrained(
 		"bert-base-uncased", # Use the 12-layer BERT model, with an uncased vocab.
-		num_labels = 1, # The number of output labels--2 for binary classification.
+		num_labels = num_topics, # The number of output labels--2 for binary classification.
 						# You can increase this for multi-class tasks.   
 		output_attentions = False, # Whether the model returns attentions weights.
 		output_hidden_states = False, # Whether the model returns all hidden-states.
-	).cuda()
-
-	optimizer = AdamW(model.parameters(),
-		lr = 2e-5, # args.learning_rate - default is 5e-5, our notebook had 2e-5
+	).to(device)
+
+	if(lora_rank is not None):
+		add_lora(model, lora_rank, lora_alpha)
+	if(gradient_checkpointing):
+		model.gradient_checkpointing_enable()
+		# With frozen embeddings, the checkpointed layers would get inputs that don't require gradients
+		if(lora_rank is not None):
+			model.enable_input_require_grads()
+	parameters = [parameter for parameter in model.parameters() if parameter.requires_grad]
+	print('Training {:,} of {:,} parameters'.format(sum(parameter.numel() for parameter in parameters), sum(parameter.numel() for parameter in model.parameters())))
+
+	# Adapters are trained with a higher learning rate than full fine-tuning
+	optimizer = AdamW(parameters,
+		lr = 2e-5 if lora_rank is None else 5e-4, # args.learning_rate - default is 5e-5, our notebook had 2e-5
 		eps = 1e-8 # args.adam_epsilon  - default is 1e-8.
 	)
 
-	total_steps = len(train_loader) * n_epochs
+	# One optimizer step per accumulation_steps batches, and one for the remaining batches of each epoch
+	total_steps = -(-len(train_loader) // accumulation_steps) * n_epochs
 	scheduler = get_linear_schedule_with_warmup(
 		optimizer, 
 		num_warmup_steps = 0, # Default value in run_glue.py
 		num_training_steps = total_steps
 	)
 
+	# fp16 gradients underflow without loss scaling
+	scaler = torch.cuda.amp.GradScaler() if precision == 'fp16' else None
+
 	# Store the average loss after each epoch so we can plot them.
 	loss_values = []
 
+	early_stopping = EarlyStopping(train_loader.dataset.dataset_name, patience=patience or n_epochs, verbose=True,
+		path='{}checkpoint_{}.pt'.format(save_path, os.getpid()), save_interval=checkpoint_interval)
+
+	# Epoch and batch to start from, and the order of the batches of that epoch if it was started
+	start_epoch, start_step, order, total_loss = 0, 0, None, 0
+	if(state is not None):
+		print('Resuming training from epoch {}, batch {}'.format(state['epoch'] + 1, state['step']))
+		model.load_state_dict(state['model'])
+		optimizer.load_state_dict(state['optimizer'])
+		scheduler.load_state_dict(state['scheduler'])
+		if(scaler is not None):
+			scaler.load_state_dict(state['scaler'])
+		early_stopping.load_state_dict(state['early_stopping'])
+		loss_values = state['loss_values']
+		start_epoch, start_step, order, total_loss = state['epoch'], state['step'], state['order'], state['total_loss']
+		# Bucket samplers draw the batches of the next epoch ahead
+		if(isinstance(train_loader.batch_sampler.batch_sampler, BucketBatchSampler)):
+			train_loader.batch_sampler.batch_sampler.batches = state['sampler']
+	last_save = time.time()
+
+	# Everything needed to continue training from epoch, after its first step batches (in order) with total_loss
+	def save_state(epoch, step, order, total_loss):
+		state_writer.save({'done': False, 'epoch': epoch, 'step': step, 'order': order, 'total_loss': total_loss,
+			'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(),
+			'scaler': scaler.state_dict() if scaler is not None else None, 'early_stopping': early_stopping.state_dict(),
+			'loss_values': loss_values, 'rng': get_rng_state(),
+			'sampler': train_loader.batch_sampler.batch_sampler.batches if isinstance(train_loader.batch_sampler.batch_sampler, BucketBatchSampler) else None})
+
 	# For each epoch...
-	for epoch_i in range(0, n_epochs):
+	for epoch_i in range(start_epoch, n_epochs):
 		
 		# ========================================
 		#			   Training
@@ -152,11 +338,30 @@ def train_bert(train_loader, valid_loader, n_epochs, batch_size, topic):
 		print('======== Epoch {:} / {:} ========'.format(epoch_i + 1, n_epochs))
 		print('Training...')
 
-		# Measure how long the training epoch takes.
-		t0 = time.time()
+		# Draw this epoch's hard negatives
+		if(isinstance(train_loader.dataset, HardNegativeDataset)):
+			train_loader.dataset.set_epoch(epoch_i)
 
-		# Reset the total loss for this epoch.
-		total_loss = 0
+		# Measure how long the training epoch takes, and how much memory it needs.
+		t0 = time.time()
+		reset_peak_memory(device)
+
+		# Draw the order of this epoch's batches, unless it is resumed part way through.
+		# The epoch runs over the batches from start_step on, in that order, set on the loader's own sampler so that
+		# its persistent workers are kept from one epoch to the next.
+		# Random number generators are restored to where they were when the state was saved: before the order of a new
+		# epoch is drawn, or once the loader of an epoch resumed part way through has drawn its seed
+		if(state is not None and order is None):
+			set_rng_state(state['rng'])
+			state = None
+		if(order is None):
+			order = [[int(index) for index in indices] for indices in train_loader.batch_sampler]
+			start_step, total_loss = 0, 0
+		train_loader.batch_sampler.set_batches(order[start_step:])
+		epoch_loader = iter(train_loader)
+		if(state is not None):
+			set_rng_state(state['rng'])
+			state = None
 
 		# Put the model into training mode. Don't be mislead--the call to 
 		# `train` just changes the *mode*, it doesn't *perform* the training.
@@ -164,8 +369,15 @@ def train_bert(train_loader, valid_loader, n_epochs, batch_size, topic):
 		# vs. test (source: https://stackoverflow.com/questions/51433378/what-does-model-train-do-in-pytorch)
 		model.train()
 
+		# Always clear any previously calculated gradients before performing a
+		# backward pass. PyTorch doesn't do this automatically because 
+		# accumulating the gradients is "convenient while training RNNs", and
+		# here to accumulate them over accumulation_steps batches.
+		# (source: https://stackoverflow.com/questions/48001598/why-do-we-need-to-call-zero-grad-in-pytorch)
+		optimizer.zero_grad()
+
 		# For each batch of training data...
-		for step, batch in enumerate(train_loader):
+		for step, batch in enumerate(epoch_loader, start_step):
 
 			# Progress update every 10 batches.
 			if step % 10 == 0 and not step == 0:
@@ -173,42 +385,23 @@ def train_bert(train_loader, valid_loader, n_epochs, batch_size, topic):
 				elapsed = format_time(time.time() - t0)
 				
 				# Report progress.
-				print('  Batch {:>5,}  of  {:>5,}.	Elapsed: {:}.'.format(step, len(train_loader), elapsed))
+				print('  Batch {:>5,}  of  {:>5,}.	Elapsed: {:}.'.format(step, len(order), elapsed))
 
-			# Unpack this training batch from our dataloader. 
-			#
-			# As we unpack the batch, we'll also copy each tensor to the GPU using the 
-			# `to` method.
+			# Perform a forward and backward pass on this training batch (see
+			# bert_backward), which accumulates the gradients.
 			#
-			# `batch` contains three pytorch tensors:
+			# `batch` contains four pytorch tensors:
 			#   [0]: input ids 
 			#   [1]: attention masks
 			#   [2]: labels 
-			b_input_ids = batch[0].to(device)
-			b_input_mask = batch[1].to(device)
-			b_labels = batch[2].to(device)
-			b_lens = batch[3]
-
-			splits = [0]
-			splits.extend(list(accumulate(b_lens)))
-
-			# Always clear any previously calculated gradients before performing a
-			# backward pass. PyTorch doesn't do this automatically because 
-			# accumulating the gradients is "convenient while training RNNs". 
-			# (source: https://stackoverflow.com/questions/48001598/why-do-we-need-to-call-zero-grad-in-pytorch)
-			model.zero_grad()		
-
-			# Perform a forward pass (evaluate the model on this training batch).
-			# This will return the loss (rather than the model output) because we
-			# have provided the `labels`.
+			#   [3]: number of sentences of each document
+			# and for packed batches the segment ids and [CLS] positions of sentences
+			#
+			# The loss is a softmax over the sentences of each document (dim 1 of
+			# the scores), averaged over the documents and topics of the batch.
 			# The documentation for this `model` function is here: 
 			# https://huggingface.co/transformers/v2.2.0/model_doc/bert.html#transformers.BertForSequenceClassification
-			outputs = model(b_input_ids, 
-						token_type_ids=None, 
-						attention_mask=b_input_mask)
-			
-			logits = outputs[0].unsqueeze(dim=0)
-			loss = criterion(logits, b_labels)
+			loss = bert_backward(model, batch, criterion, device, precision, scaler, accumulation_steps)
 
 			# Accumulate the training loss over all of the batches so that we can
 			# calculate the average loss at the end. `loss` is a Tensor containing a
@@ -216,23 +409,19 @@ def train_bert(train_loader, valid_loader, n_epochs, batch_size, topic):
 			# from the tensor.
 			total_loss += loss.item()
 
-			# Perform a backward pass to calculate the gradients.
-			loss.backward()
-
-			# Clip the norm of the gradients to 1.0.
-			# This is to help prevent the "exploding gradients" problem.
-			torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-
-			# Update parameters and take a step using the computed gradient.
-			# The optimizer dictates the "update rule"--how the parameters are
-			# modified based on their gradients, the learning rate, etc.
-			optimizer.step()
+			# Every accumulation_steps batches (and after the last one), clip the norm
+			# of the gradients to 1.0, update parameters and the learning rate.
+			if((step + 1) % accumulation_steps == 0 or step + 1 == len(order)):
+				bert_optimizer_step(parameters, optimizer, scheduler, scaler)
 
-			# Update the learning rate.
-			scheduler.step()
+				# Save the training state every state_interval seconds, between optimizer steps
+				if(state_writer is not None and time.time() - last_save > state_interval and step + 1 < len(order)):
+					save_state(epoch_i, step + 1, order, total_loss)
+					last_save = time.time()
 
 		# Calculate the average loss over the training data.
-		avg_train_loss = total_loss / len(train_loader)			
+		avg_train_loss = total_loss / len(order)
+		order = None
 		
 		# Store the loss value for plotting the learning curve.
 		loss_values.append(avg_train_loss)
@@ -240,6 +429,7 @@ def train_bert(train_loader, valid_loader, n_epochs, batch_size, topic):
 		print("")
 		print("  Average training loss: {0:.2f}".format(avg_train_loss))
 		print("  Training epoch took: {:}".format(format_time(time.time() - t0)))
+		print("  Step time: {:.0f} ms per batch, peak memory: {:,.0f} MB".format(1000 * (time.time() - t0) / max(len(train_loader) - start_step, 1), peak_memory(device)))
 			
 		# ========================================
 		#			   Validation
@@ -264,32 +454,20 @@ def train_bert(train_loader, valid_loader, n_epochs, batch_size, topic):
 		for batch in valid_loader:
 			
 			# Add batch to GPU
-			b_input_ids = batch[0].to(device)
-			b_input_mask = batch[1].to(device)
-			b_labels = batch[2].to(device)
-			b_lens = batch[3]
+			b_labels = to_device(batch[2], device)
 			
 			# Telling the model not to compute or store gradients, saving memory and
 			# speeding up validation
-			with torch.no_grad():		
-
-				# Forward pass, calculate logit predictions.
-				# This will return the logits rather than the loss because we have
-				# not provided labels.
-				# token_type_ids is the same as the "segment ids", which 
-				# differentiates sentence 1 and 2 in 2-sentence tasks.
-				# The documentation for this `model` function is here: 
-				# https://huggingface.co/transformers/v2.2.0/model_doc/bert.html#transformers.BertForSequenceClassification
-				outputs = model(b_input_ids, 
-								token_type_ids=None, 
-								attention_mask=b_input_mask)
+			with torch.no_grad(), torch.autocast(device.type, dtype=BERT_PRECISIONS[precision], enabled=precision != 'fp32'):
+
+				# Forward pass, calculate logit predictions for the sentences of
+				# each document.
+				scores = score_documents(model, batch, device).float()
 			
-			# Get the "logits" output by the model. The "logits" are the output
-			# values prior to applying an activation function like the softmax.
-			logits = outputs[0]
+			eval_loss += criterion(scores, b_labels).item()
 
 			# Move logits and labels to CPU
-			logits = logits.detach().cpu().numpy()
+			logits = scores.detach().cpu().numpy()
 			label_ids = b_labels.to('cpu').numpy()
 			
 			# Calculate the accuracy for this batch of test sentences.
@@ -302,28 +480,132 @@ def train_bert(train_loader, valid_loader, n_epochs, batch_size, topic):
 			nb_eval_steps += 1
 
 		# Report the final accuracy for this validation run.
+		print("  Loss: {0:.2f}".format(eval_loss/nb_eval_steps))
 		print("  Accuracy: {0:.2f}".format(eval_accuracy/nb_eval_steps))
 		print("  Validation took: {:}".format(format_time(time.time() - t0)))
 
+		# Keep the model if it has the lowest validation loss so far
+		early_stopping(eval_loss/nb_eval_steps, model)
+		if early_stopping.early_stop:
+			print("Early stopping")
+			break
+
+		# Save the training state at the start of the next epoch
+		if(state_writer is not None):
+			save_state(epoch_i + 1, 0, None, 0)
+			last_save = time.time()
+
 	print("")
 	print("Training complete!")
 
-	save_path = '../models/{}/bert/{}/'.format(train_loader.dataset.dataset_name, topic)
+	early_stopping.load_best(model)
 
-	if not os.path.exists(save_path):
-		os.makedirs(save_path)
+	# The packing options of the train loader are saved with the model, eval.py evaluates it with the same ones
+	model.config.pack, model.config.pack_overlap = pack, pack_overlap
 
 	print("Saving model to %s" % save_path)
 
-	model.save_pretrained(save_path)
+	if(lora_rank is not None):
+		save_adapter(model, save_path, "bert-base-uncased", lora_rank, lora_alpha)
+	else:
+		# An adapter left from an earlier run would be loaded instead of this model
+		if(has_adapter(save_path)):
+			os.remove(save_path + ADAPTER_FILE)
+		model.save_pretrained(save_path)
+	early_stopping.close()
+
+	results = {'epochs': len(loss_values), 'train_loss': loss_values[-1], 'valid_loss': early_stopping.val_loss_min}
+
+	# Resuming a completed run only returns its results
+	if(state_writer is not None):
+		state_writer.save({'done': True, 'results': results})
+		state_writer.wait()
+
+	return results
+
+# Datasets and options shared by the per-topic training jobs of train_topics
+# Set before the pool is created so that forked worker processes inherit the loaded data instead of receiving a copy
+topic_job_state = {}
+
+# Train the model of one topic on its subset of the shared datasets, in threads threads
+def train_topic_job(topic):
+	state = topic_job_state
+	torch.set_num_threads(state['threads'])
+	print('[I] Training topic {}'.format(topic))
+	t0 = time.time()
+	train_loader = get_loader(state['train_data'].topic_subset(topic), state['batch_size'], **state['loader_args'])
+	valid_loader = get_loader(state['valid_data'].topic_subset(topic), state['batch_size'], **state['loader_args'])
+	results = state['train_fn'](train_loader, valid_loader, state['epochs'], state['batch_size'], topic, device=state['device'])
+	results.update(topic=topic, documents=len(train_loader.dataset), seconds=time.time() - t0)
+	return results
+
+# Train a separate model for each of topics (all topics if topics is None), loading the train and validation
+# splits once and training workers topics at a time in a process pool, each job using threads threads
+# Timing and final losses of every topic are written to ../models/{dataset_name}/{model_type}/training_summary.json
+def train_topics(dataset_name, model_type, topics, train_fn, batch_size, epochs, device, workers=1, threads=1, mini=False, preload=False, preload_max_gb=8.0, negatives=None, negative_pool=None, loader_args={}):
+	t0 = time.time()
+	train_data = create_dataset(dataset_name, model_type, 'train', 'all', mini, preload, preload_max_gb, negatives, negative_pool)
+	valid_data = create_dataset(dataset_name, model_type, 'val', 'all', mini, preload, preload_max_gb, negatives, negative_pool)
+	if(topics is None):
+		topics = list(range(len(next(iter(train_data.labels.values()), []))))
+
+	topic_job_state.update(train_data=train_data, valid_data=valid_data, train_fn=train_fn, batch_size=batch_size,
+		epochs=epochs, device=device, threads=threads, loader_args=loader_args)
+	if(workers > 1):
+		# Jobs run in daemon processes, which can't start DataLoader workers of their own
+		topic_job_state['loader_args'] = dict(loader_args, num_workers=0)
+		with multiprocessing.get_context('fork').Pool(workers) as pool:
+			results = pool.map(train_topic_job, topics, chunksize=1)
+	else:
+		results = [train_topic_job(topic) for topic in topics]
+
+	summary = {'topics': results, 'workers': workers, 'threads': threads, 'seconds': time.time() - t0}
+	summary_path = '../models/{}/{}/training_summary.json'.format(dataset_name, model_type)
+	with open(summary_path, 'w') as outfile:
+		json.dump(summary, outfile, indent=1)
+	for result in results:
+		print('Topic {}: {:.1f}s, {}'.format(result['topic'], result['seconds'], ', '.join('{} {:.5f}'.format(key, value) for key, value in result.items() if 'loss' in key or 'accuracy' in key)))
+	print('Trained {} topics in {:.1f}s, summary written to {}'.format(len(results), summary['seconds'], summary_path))
 
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-dataset_name')
 	parser.add_argument('-model_type')
-	# Models are trained per topic
-	parser.add_argument('-topic', type=int)
+	# Models are trained per topic, give several topics or all to train each of them in one run
+	parser.add_argument('-topic', nargs='+')
+	# When training several topics, how many are trained at the same time (each in its own process) and with how many threads
+	parser.add_argument('-topic_workers', type=int, default=1)
+	parser.add_argument('-threads', type=int, default=1)
+	# Train linear models for all topics at once instead, in a single pass over the data per epoch
+	parser.add_argument('-all_topics', action='store_true', default=False)
+	# For linear and embedding models, give the model a hidden layer of this size
+	parser.add_argument('-hidden', type=int, default=None)
+	# For linear and embedding models, train with Adam on minibatches with early stopping (adam) or with
+	# full-batch L-BFGS with l2 regularization of strength l2 (lbfgs)
+	parser.add_argument('-solver', default='adam', choices=['adam', 'lbfgs'])
+	parser.add_argument('-l2', type=float, default=1e-4)
+	# Linear models stop after patience epochs without improvement in validation loss, BERT models only if it is set
+	parser.add_argument('-patience', type=int, default=None)
+	# If set, also write the best model so far to disk every checkpoint_interval seconds, in the background
+	parser.add_argument('-checkpoint_interval', type=float, default=None)
+	# For BERT models, train low-rank adapters of this rank (and scale alpha) on frozen BERT instead of all of BERT
+	parser.add_argument('-lora_rank', type=int, default=None)
+	parser.add_argument('-lora_alpha', type=float, default=16)
+	'''
+	BERT models are trained in precision fp32, bf16 or fp16 (mixed precision with autocast, fp16 needs a GPU), with
+	gradients accumulated over accumulation_steps batches per optimizer step, and with gradient checkpointing of
+	encoder layers if gradient_checkpointing is set
+	'''
+	parser.add_argument('-precision', default='fp32', choices=['fp32', 'bf16', 'fp16'])
+	parser.add_argument('-accumulation_steps', type=int, default=1)
+	parser.add_argument('-gradient_checkpointing', action='store_true', default=False)
+	'''
+	For BERT models, write the training state every state_interval seconds and after every epoch, and with resume,
+	continue training from that state where an earlier run stopped
+	'''
+	parser.add_argument('-state_interval', type=float, default=None)
+	parser.add_argument('-resume', action='store_true', default=False)
 	'''
 	Recommended batch sizes:
 	BERT: 1
@@ -342,31 +624,100 @@ if __name__ == '__main__':
 	For more details, seee src/models/data_loader.py
 	'''
 	parser.add_argument('-m', '--mini', action='store_true', default=False)
+	'''
+	If negatives is set, BERT models are trained on documents reduced to their oracle and the negatives other sentences
+	the trained linear model of the topic scores highest, drawn every epoch from the negative_pool highest if it is set
+	'''
+	parser.add_argument('-negatives', type=int, default=None)
+	parser.add_argument('-negative_pool', type=int, default=None)
+	'''
+	For linear models, load each split into memory once instead of reading every document from disk every epoch
+	Falls back to reading from disk if the split would take more than preload_max_gb gigabytes
+	'''
+	parser.add_argument('-preload', action='store_true', default=False)
+	parser.add_argument('-preload_max_gb', type=float, default=8.0)
+	'''
+	BERT sentences are truncated to max_sent_len tokens, or if sent_len_percentile is set (e.g. 95),
+	to that percentile of sentence lengths in each batch if it is shorter
+	'''
+	parser.add_argument('-max_sent_len', type=int, default=512)
+	parser.add_argument('-sent_len_percentile', type=float, default=None)
+	'''
+	If pack is set, the sentences of each BERT document are packed into shared sequences of up to 512 tokens,
+	each scored at its own [CLS] token, with pack_overlap sentences of context between the windows of longer documents
+	'''
+	parser.add_argument('-pack', action='store_true', default=False)
+	parser.add_argument('-pack_overlap', type=int, default=2)
+	'''
+	If bucket is set, batches group documents with similar numbers of sentences (and sentence lengths for BERT)
+	If max_tokens is also set, batches hold as many documents as fit in max_tokens padded sentences (linear)
+	or tokens (BERT) instead of batch_size documents
+	'''
+	parser.add_argument('-bucket', action='store_true', default=False)
+	parser.add_argument('-max_tokens', type=int, default=None)
+	# Device to train on, e.g. cpu, cuda or cuda:1 - auto uses the GPU if there is one
+	parser.add_argument('-device', default='auto')
+	# Number of worker processes loading and collating batches, and how many batches each keeps ready
+	parser.add_argument('-num_workers', type=int, default=0)
+	parser.add_argument('-prefetch_factor', type=int, default=2)
 
 	args = parser.parse_args()
-
-	dataset_name, model_type, topic, batch_size, epochs, mini = \
-		args.dataset_name, args.model_type, args.topic, args.batch_size, args.epochs, args.mini
-
-	train_loader = create_loader(dataset_name, model_type, 'train', topic, batch_size, mini)
-	valid_loader = create_loader(dataset_name, model_type, 'val', topic, batch_size, mini)
+	device = get_device(args.device)
+
+	dataset_name, model_type, batch_size, epochs, mini = \
+		args.dataset_name, args.model_type, args.batch_size, args.epochs, args.mini
+
+	# A single topic is trained as before, several topics (or all, topics None) are scheduled by train_topics
+	topics = None if args.topic in (None, ['all']) else [int(topic) for topic in args.topic]
+	topic = topics[0] if topics is not None and len(topics) == 1 else None
+	if(args.all_topics):
+		if(model_type not in ('linear', 'embedding')):
+			parser.error('-all_topics is only supported for linear and embedding models')
+		topic = 'all'
+	# Multi-topic BERT shares one encoder between all topics, so it is always trained for all of them
+	elif(model_type == 'multi_bert'):
+		topic = 'all'
+	elif(args.topic is None):
+		parser.error('-topic is required, give a topic, several topics or all')
+	# Topic jobs run in forked processes, and CUDA set up in this process (get_device already did) can't be used after a fork
+	if(topic is None and args.topic_workers > 1 and device.type != 'cpu'):
+		parser.error('-topic_workers > 1 is only supported on the CPU, use -device cpu or train the topics one at a time on {}'.format(device))
+	if(topic == 'all' and mini):
+		parser.error('-mini keeps the oracle of a single topic, so it can\'t be used to train all topics at once')
+	if(args.negatives is not None):
+		if(model_type != 'bert'):
+			parser.error('-negatives is only supported for BERT models')
+		if(mini):
+			parser.error('-negatives and -mini both reduce documents, use one of them')
+		# With all topics, missing models are only found when a topic's sentences are ranked
+		missing = [t for t in (topics or []) if not os.path.exists('../models/{}/linear/{}.th'.format(dataset_name, t))]
+		if(missing):
+			parser.error('-negatives needs the linear models of the topics, train them first (missing topics {})'.format(', '.join(str(t) for t in missing)))
 
 	save_dir = '../models/{}/{}/'.format(dataset_name, model_type)
 	if not os.path.exists(save_dir):
 		os.makedirs(save_dir)
 
 	# Set training function based on model type
-	if(model_type == 'linear'):
-		train_fn = train_linear
-	elif(model_type == 'bert'):
-		train_fn = train_bert
-
-	train_fn(train_loader, valid_loader, epochs, batch_size, topic)
-
-
-
-
-
-
-
-
+	if(model_type in ('linear', 'embedding') and args.solver == 'lbfgs'):
+		if(args.hidden is not None):
+			parser.error('-solver lbfgs is only supported for models without a hidden layer')
+		train_fn = functools.partial(train_linear_lbfgs, l2=args.l2)
+	elif(model_type in ('linear', 'embedding')):
+		train_fn = functools.partial(train_linear, hidden=args.hidden, patience=args.patience or 7, checkpoint_interval=args.checkpoint_interval)
+	elif(model_type in ('bert', 'multi_bert')):
+		if(args.precision == 'fp16' and device.type != 'cuda'):
+			parser.error('-precision fp16 needs a GPU, use bf16 on the CPU')
+		train_fn = functools.partial(train_bert, lora_rank=args.lora_rank, lora_alpha=args.lora_alpha, patience=args.patience, checkpoint_interval=args.checkpoint_interval,
+			precision=args.precision, accumulation_steps=args.accumulation_steps, gradient_checkpointing=args.gradient_checkpointing,
+			state_interval=args.state_interval, resume=args.resume, pack=args.pack, pack_overlap=args.pack_overlap)
+
+	loader_args = {'max_sent_len': args.max_sent_len, 'sent_len_percentile': args.sent_len_percentile, 'bucket': args.bucket, 'max_tokens': args.max_tokens,
+		'pin_memory': device.type == 'cuda', 'num_workers': args.num_workers, 'prefetch_factor': args.prefetch_factor, 'pack': args.pack, 'pack_overlap': args.pack_overlap}
+
+	if(topic is None):
+		train_topics(dataset_name, model_type, topics, train_fn, batch_size, epochs, device, args.topic_workers, args.threads, mini, args.preload, args.preload_max_gb, args.negatives, args.negative_pool, loader_args)
+	else:
+		train_loader = create_loader(dataset_name, model_type, 'train', topic, batch_size, mini, args.preload, args.preload_max_gb, negatives=args.negatives, negative_pool=args.negative_pool, **loader_args)
+		valid_loader = create_loader(dataset_name, model_type, 'val', topic, batch_size, mini, args.preload, args.preload_max_gb, negatives=args.negatives, negative_pool=args.negative_pool, **loader_args)
+		train_fn(train_loader, valid_loader, epochs, batch_size, topic, device=device)
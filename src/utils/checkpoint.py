@@ -0,0 +1,58 @@
+import os
+import random
+import threading
+import numpy as np
+import torch
+
+# Copy of a (nested) state, e.g. a model or optimizer state dict, with every tensor copied to the CPU
+# Training can go on while the copy is written
+def cpu_state(state):
+	if(isinstance(state, torch.Tensor)):
+		return state.detach().to('cpu', copy=True)
+	elif(isinstance(state, dict)):
+		return {key : cpu_state(value) for key, value in state.items()}
+	elif(isinstance(state, (list, tuple))):
+		return type(state)(cpu_state(value) for value in state)
+	return state
+
+# State of the python, numpy and torch (CPU and GPU) random number generators
+def get_rng_state():
+	state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+	if(torch.cuda.is_available()):
+		state['cuda'] = torch.cuda.get_rng_state_all()
+	return state
+
+def set_rng_state(state):
+	random.setstate(state['python'])
+	np.random.set_state(state['numpy'])
+	torch.set_rng_state(state['torch'])
+	if('cuda' in state and torch.cuda.is_available()):
+		torch.cuda.set_rng_state_all(state['cuda'])
+
+# Writes checkpoints to path in a background thread, through a temporary file so that path always holds a complete
+# checkpoint even if the process is killed while writing
+# save copies the state to the CPU before returning, and waits for the previous checkpoint to be written if it hasn't been
+class CheckpointWriter:
+	def __init__(self, path):
+		self.path = path
+		self.thread = None
+
+	def save(self, state):
+		state = cpu_state(state)
+		self.wait()
+		self.thread = threading.Thread(target=self.write, args=(state,))
+		self.thread.start()
+
+	def write(self, state):
+		torch.save(state, self.path + '.tmp')
+		os.replace(self.path + '.tmp', self.path)
+
+	def wait(self):
+		if(self.thread is not None):
+			self.thread.join()
+			self.thread = None
+
+def load_checkpoint(path):
+	if(not os.path.exists(path)):
+		return None
+	return torch.load(path, map_location='cpu', weights_only=False)
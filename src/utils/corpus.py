@@ -0,0 +1,155 @@
+import os
+import gzip
+import json
+import array
+import numpy as np
+
+'''
+Sharded, line-delimited store for per-document raw artifacts (documents, summaries)
+A store is a directory containing:
+	meta.json - number of records, number of shards, records per shard and compression
+	shard-XXXXX.jsonl[.gz|.zst] - one json record per line, records_per_shard records per shard
+	index.npy - (num_records, 3) int64 array of (shard, byte offset, byte length) for every record
+Compressed shards hold each record as its own gzip member/zstd frame so that any record can be read
+with a single seek and decompress, while the shard as a whole is still a valid .jsonl.gz/.jsonl.zst file
+'''
+
+EXTENSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+# Get (compress, decompress) functions for a compression type
+def get_codec(compression):
+	if(compression == 'none'):
+		return (lambda data: data), (lambda data: data)
+	elif(compression == 'gzip'):
+		return (lambda data: gzip.compress(data, compresslevel=6)), gzip.decompress
+	elif(compression == 'zstd'):
+		try:
+			import zstandard
+		except ImportError:
+			raise ImportError('zstd compression requires the zstandard package, install it with pip install zstandard or use gzip compression')
+		return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+	raise ValueError('Unknown compression {}, expected one of {}'.format(compression, list(EXTENSIONS)))
+
+def get_shard_path(path, shard, compression):
+	return '{}/shard-{:05d}.jsonl{}'.format(path, shard, EXTENSIONS[compression])
+
+# Check whether a sharded store exists at path
+def corpus_exists(path):
+	return os.path.exists(path + '/meta.json')
+
+# Delete the sharded store at path if there is one, and its directory if nothing else is in it
+def remove_corpus(path):
+	if(not os.path.exists(path)):
+		return
+	for file in os.listdir(path):
+		if(file.startswith('shard-') or file in ('index.npy', 'meta.json')):
+			os.remove(path + '/' + file)
+	if(not os.listdir(path)):
+		os.rmdir(path)
+
+# Writes records one at a time to a sharded store, only the current shard's file handle and the offset index are kept in memory
+class CorpusWriter:
+	def __init__(self, path, compression='gzip', records_per_shard=10000):
+		remove_corpus(path)
+		os.makedirs(path, exist_ok=True)
+		self.path = path
+		self.compression = compression
+		self.records_per_shard = records_per_shard
+		self.compress, _ = get_codec(compression)
+		# Flat (shard, offset, length) triples
+		self.index = array.array('q')
+		self.num_records = 0
+		self.file = None
+
+	def write(self, record):
+		shard = self.num_records // self.records_per_shard
+		if(self.num_records % self.records_per_shard == 0):
+			if(self.file is not None):
+				self.file.close()
+			self.file = open(get_shard_path(self.path, shard, self.compression), 'wb')
+		data = self.compress((json.dumps(record) + '\n').encode('utf-8'))
+		self.index.extend((shard, self.file.tell(), len(data)))
+		self.file.write(data)
+		self.num_records += 1
+
+	def close(self):
+		if(self.file is not None):
+			self.file.close()
+		np.save(self.path + '/index.npy', np.frombuffer(self.index, dtype=np.int64).reshape(-1, 3))
+		meta = {
+			'num_records': self.num_records,
+			'num_shards': (self.num_records + self.records_per_shard - 1) // self.records_per_shard,
+			'records_per_shard': self.records_per_shard,
+			'compression': self.compression
+		}
+		# Meta is written last so that a store is only picked up by readers once it is complete
+		with open(self.path + '/meta.json', 'w') as outfile:
+			json.dump(meta, outfile)
+
+# Read-only view of a sharded store that behaves like a list of records
+# Indexing reads a single record in O(1), iterating streams one shard at a time
+class ShardedCorpus:
+	def __init__(self, path):
+		self.path = path
+		with open(path + '/meta.json') as json_file:
+			self.meta = json.load(json_file)
+		self.compression = self.meta['compression']
+		self.index = None
+		self.files = {}
+		self.decompress = None
+
+	# Index, codec and file handles are opened lazily so that the corpus can be sent to worker processes
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state.update(index=None, files={}, decompress=None)
+		return state
+
+	def open(self):
+		if(self.index is None):
+			self.index = np.load(self.path + '/index.npy', mmap_mode='r')
+			_, self.decompress = get_codec(self.compression)
+
+	def __len__(self):
+		return self.meta['num_records']
+
+	def __getitem__(self, i):
+		if(i < 0):
+			i += len(self)
+		if(i < 0 or i >= len(self)):
+			raise IndexError('record index out of range')
+		self.open()
+		shard, offset, length = (int(x) for x in self.index[i])
+		if(shard not in self.files):
+			self.files[shard] = open(get_shard_path(self.path, shard, self.compression), 'rb')
+		file = self.files[shard]
+		file.seek(offset)
+		return json.loads(self.decompress(file.read(length)))
+
+	# Yields (ids, records) for each shard, reading each shard file once
+	def iter_shards(self):
+		self.open()
+		for shard in range(self.meta['num_shards']):
+			start = shard * self.meta['records_per_shard']
+			end = min(start + self.meta['records_per_shard'], len(self))
+			with open(get_shard_path(self.path, shard, self.compression), 'rb') as file:
+				data = file.read()
+			records = [json.loads(self.decompress(data[offset:offset+length])) for _, offset, length in self.index[start:end]]
+			yield list(range(start, end)), records
+
+	def __iter__(self):
+		for ids, records in self.iter_shards():
+			yield from records
+
+	def close(self):
+		for file in self.files.values():
+			file.close()
+		self.files = {}
+
+# Load a raw artifact (documents or summaries) of a dataset from ../data/{dataset_name}/raw/
+# Uses the sharded store if it exists, otherwise falls back to the monolithic json file
+def load_raw(dataset_name, name):
+	path = '../data/{}/raw/{}'.format(dataset_name, name)
+	if(corpus_exists(path)):
+		return ShardedCorpus(path)
+	with open(path + '.json') as json_file:
+		return json.load(json_file)
@@ -0,0 +1,28 @@
+import torch
+import resource
+
+# Get the torch device to run on, auto picks the GPU if there is one and the CPU otherwise
+def get_device(name='auto'):
+	if(name is None or name == 'auto'):
+		name = 'cuda' if torch.cuda.is_available() else 'cpu'
+	return torch.device(name)
+
+# Move a tensor, or every tensor in a tuple/list of them (e.g. a collated batch), to device
+# Copies to an accelerator are non-blocking, which overlaps them with compute when the loader pins memory
+def to_device(batch, device):
+	if(isinstance(batch, (list, tuple))):
+		return type(batch)(to_device(item, device) for item in batch)
+	elif(isinstance(batch, torch.Tensor)):
+		return batch.to(device, non_blocking=device.type != 'cpu')
+	return batch
+
+# Peak memory in MB: allocated by tensors on device since the last reset_peak_memory for a GPU, or the peak resident
+# size of the process for the CPU (which can't be reset)
+def peak_memory(device):
+	if(device.type == 'cuda'):
+		return torch.cuda.max_memory_allocated(device) / 1024 ** 2
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def reset_peak_memory(device):
+	if(device.type == 'cuda'):
+		torch.cuda.reset_peak_memory_stats(device)
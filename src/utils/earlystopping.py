@@ -1,26 +1,49 @@
+import os
+import time
+import threading
 import numpy as np
 import torch
 
 class EarlyStopping:
-    """Early stops the training if validation loss doesn't improve after a given patience."""
-    def __init__(self, dataset_name, patience=7, verbose=False, delta=0):
+    """Early stops the training if validation loss doesn't improve after a given patience.
+    The best model's state is kept in memory, and only written to disk by a background thread if save_interval is set."""
+    def __init__(self, dataset_name, patience=7, verbose=False, delta=0, model_type='linear', path=None, save_interval=None):
         """
         Args:
             patience (int): How long to wait after last time validation loss improved.
                             Default: 7
-            verbose (bool): If True, prints a message for each validation loss improvement. 
+            verbose (bool): If True, prints a message for each validation loss improvement.
                             Default: False
             delta (float): Minimum change in the monitored quantity to qualify as an improvement.
                             Default: 0
+            model_type (str): Models directory the checkpoint is saved in.
+                            Default: 'linear'
+            path (str): Path the best state is written to if save_interval is set.
+                            Default: checkpoint_{pid}_{time}.pt in the models directory, unique to the run
+            save_interval (float): If set, write the best state to path (if it changed) at most every save_interval
+                            seconds, in the background. The file is deleted on close, once the final model is saved.
+                            Default: None
         """
         self.patience = patience
         self.verbose = verbose
         self.counter = 0
         self.best_score = None
         self.early_stop = False
-        self.val_loss_min = np.Inf
+        self.val_loss_min = np.inf
         self.delta = delta
         self.dataset_name = dataset_name
+        self.model_type = model_type
+        self.path = path if path is not None else '../models/{}/{}/checkpoint_{}_{}.pt'.format(dataset_name, model_type, os.getpid(), int(time.time()))
+        self.save_interval = save_interval
+        self.best_state = None
+        self.version = 0
+        self.saved_version = 0
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.writer = None
+        if save_interval is not None:
+            self.writer = threading.Thread(target=self.write_loop, daemon=True)
+            self.writer.start()
 
     def __call__(self, val_loss, model):
 
@@ -40,8 +63,48 @@ class EarlyStopping:
             self.counter = 0
 
     def save_checkpoint(self, val_loss, model):
-        '''Saves model when validation loss decrease.'''
+        '''Keeps a copy of the model's state in memory when validation loss decreases.'''
         if self.verbose:
             print(f'Validation loss decreased ({self.val_loss_min:.6f} --> {val_loss:.6f}).  Saving model ...')
-        torch.save(model.state_dict(), '../models/{}/linear/checkpoint.pt'.format(self.dataset_name))
-        self.val_loss_min = val_loss
\ No newline at end of file
+        state = {name: value.detach().to('cpu', copy=True) for name, value in model.state_dict().items()}
+        with self.lock:
+            self.best_state = state
+            self.version += 1
+        self.val_loss_min = val_loss
+
+    def load_best(self, model):
+        '''Loads the best state into model.'''
+        model.load_state_dict(self.best_state)
+
+    def state_dict(self):
+        '''Returns what is needed to continue early stopping where it is, e.g. after resuming training.'''
+        return {'best_score': self.best_score, 'counter': self.counter, 'val_loss_min': self.val_loss_min, 'best_state': self.best_state}
+
+    def load_state_dict(self, state):
+        self.best_score, self.counter, self.val_loss_min = state['best_score'], state['counter'], state['val_loss_min']
+        with self.lock:
+            self.best_state = state['best_state']
+            self.version += 1
+
+    def write(self):
+        '''Writes the best state to path if it changed since the last write, through a temporary file so that path always holds a complete checkpoint.'''
+        with self.lock:
+            state, version = self.best_state, self.version
+        if state is None or version == self.saved_version:
+            return
+        torch.save(state, self.path + '.tmp')
+        os.replace(self.path + '.tmp', self.path)
+        self.saved_version = version
+
+    def write_loop(self):
+        while not self.closed.wait(self.save_interval):
+            self.write()
+
+    def close(self):
+        '''Stops the background writer and deletes the checkpoint, call it after the final model is saved.'''
+        if self.writer is not None:
+            self.closed.set()
+            self.writer.join()
+            for path in [self.path, self.path + '.tmp']:
+                if os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,181 @@
+import os
+import json
+import numpy as np
+from scipy import sparse
+
+'''
+On-disk formats for per-split features, stored in ../data/{dataset_name}/{model_type}/{split}/
+Sparse linear features: features.npz holds one CSR matrix with a row per sentence for every document
+in the split, along with doc_offsets (row where each document starts, plus the total) and doc_ids
+Packed BERT tokens: tokens.bin holds the token ids of every sentence of every document back to back
+(uint16 when the vocabulary fits, int32 otherwise), sent_offsets.npy where each sentence starts in tokens.bin,
+doc_offsets.npy where each document starts in sent_offsets.npy (both with the total appended), doc_ids.npy
+the document id of each document and packed.json the token dtype and counts
+Sentence embeddings: embeddings.npy holds a float16 (num_sentences, dim) array with a row per sentence, in the
+order of the split's BERT tokens, along with doc_offsets.npy, doc_ids.npy and embedding.json (encoder, pooling, shape)
+'''
+
+SPARSE_FEATURES_FILE = 'features.npz'
+PACKED_META_FILE = 'packed.json'
+EMBEDDING_META_FILE = 'embedding.json'
+
+# Write per-document CSR feature matrices of a split as a single CSR matrix
+def save_sparse_split(path, features, doc_ids):
+	matrix = sparse.vstack(features, format='csr', dtype=np.float32)
+	doc_offsets = np.zeros(len(features) + 1, dtype=np.int64)
+	doc_offsets[1:] = np.cumsum([f.shape[0] for f in features])
+	np.savez(path + SPARSE_FEATURES_FILE, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+		shape=np.array(matrix.shape), doc_offsets=doc_offsets, doc_ids=np.array(doc_ids, dtype=np.int64))
+
+# Writes the CSR feature matrices of a split's documents one document at a time, into the same features.npz as
+# save_sparse_split. Values and column indices are appended to temporary files, only the row pointers and offsets
+# are kept in memory until close, which copies the temporary files into features.npz through memory maps
+class SparseFeatureWriter:
+	def __init__(self, path, num_features):
+		self.path = path
+		self.num_features = num_features
+		self.data_file = open(path + 'data.tmp', 'wb')
+		self.indices_file = open(path + 'indices.tmp', 'wb')
+		self.indptr = [0]
+		self.doc_offsets = [0]
+		self.doc_ids = []
+
+	def write(self, doc_id, features):
+		features = sparse.csr_matrix(features, dtype=np.float32)
+		features.data.tofile(self.data_file)
+		features.indices.astype(np.int32).tofile(self.indices_file)
+		self.indptr.extend((self.indptr[-1] + features.indptr[1:]).tolist())
+		self.doc_offsets.append(len(self.indptr) - 1)
+		self.doc_ids.append(doc_id)
+
+	def close(self):
+		self.data_file.close()
+		self.indices_file.close()
+		num_values = self.indptr[-1]
+		# Empty files can't be memory-mapped
+		load = lambda name, dtype: np.memmap(self.path + name, dtype=dtype, mode='r') if num_values > 0 else np.zeros(0, dtype=dtype)
+		data, indices = load('data.tmp', np.float32), load('indices.tmp', np.int32)
+		indptr = np.array(self.indptr, dtype=np.int32 if num_values <= np.iinfo(np.int32).max else np.int64)
+		np.savez(self.path + SPARSE_FEATURES_FILE, data=data, indices=indices, indptr=indptr,
+			shape=np.array([len(self.indptr) - 1, self.num_features]), doc_offsets=np.array(self.doc_offsets, dtype=np.int64),
+			doc_ids=np.array(self.doc_ids, dtype=np.int64))
+		del data, indices
+		os.remove(self.path + 'data.tmp')
+		os.remove(self.path + 'indices.tmp')
+
+def has_sparse_split(path):
+	return os.path.exists(path + SPARSE_FEATURES_FILE)
+
+# Load the CSR matrix, document offsets and document ids of a split
+def load_sparse_split(path):
+	with np.load(path + SPARSE_FEATURES_FILE) as npz:
+		matrix = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape']))
+		return matrix, npz['doc_offsets'], npz['doc_ids']
+
+# Only read the document ids of a split
+def load_sparse_doc_ids(path):
+	with np.load(path + SPARSE_FEATURES_FILE) as npz:
+		return npz['doc_ids']
+
+# Writes documents of token ids to a packed split one document at a time
+# Tokens are appended straight to tokens.bin, only the offsets are kept in memory until close
+class PackedTokenWriter:
+	def __init__(self, path, vocab_size):
+		self.path = path
+		self.dtype = np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.int32
+		self.file = open(path + 'tokens.bin', 'wb')
+		self.sent_offsets = [0]
+		self.doc_offsets = [0]
+		self.doc_ids = []
+
+	# sentences is a list of token id sequences (lists, arrays or tensors)
+	def write(self, doc_id, sentences):
+		for sentence in sentences:
+			sentence = np.asarray(sentence, dtype=self.dtype)
+			sentence.tofile(self.file)
+			self.sent_offsets.append(self.sent_offsets[-1] + len(sentence))
+		self.doc_offsets.append(len(self.sent_offsets) - 1)
+		self.doc_ids.append(doc_id)
+
+	def close(self):
+		self.file.close()
+		np.save(self.path + 'sent_offsets.npy', np.array(self.sent_offsets, dtype=np.int64))
+		np.save(self.path + 'doc_offsets.npy', np.array(self.doc_offsets, dtype=np.int64))
+		np.save(self.path + 'doc_ids.npy', np.array(self.doc_ids, dtype=np.int64))
+		meta = {'dtype': np.dtype(self.dtype).name, 'num_tokens': self.sent_offsets[-1], 'num_sentences': len(self.sent_offsets) - 1, 'num_documents': len(self.doc_ids)}
+		with open(self.path + PACKED_META_FILE, 'w') as outfile:
+			json.dump(meta, outfile)
+
+def has_packed_split(path):
+	return os.path.exists(path + PACKED_META_FILE)
+
+def load_packed_doc_ids(path):
+	return np.load(path + 'doc_ids.npy')
+
+# Memory-mapped, read-only view of a packed split
+# Arrays are mapped on first access, so the store can be sent to DataLoader workers which then share the page cache
+class PackedTokenStore:
+	def __init__(self, path):
+		self.path = path
+		with open(path + PACKED_META_FILE) as json_file:
+			self.meta = json.load(json_file)
+		self.tokens = None
+
+	# Only send the path and meta, the mapped arrays are reopened by the receiving process
+	def __getstate__(self):
+		return {'path': self.path, 'meta': self.meta, 'tokens': None}
+
+	def open(self):
+		if(self.tokens is None):
+			self.tokens = np.memmap(self.path + 'tokens.bin', dtype=self.meta['dtype'], mode='r', shape=(self.meta['num_tokens'],))
+			self.sent_offsets = np.load(self.path + 'sent_offsets.npy', mmap_mode='r')
+			self.doc_offsets = np.load(self.path + 'doc_offsets.npy', mmap_mode='r')
+			self.doc_ids = np.load(self.path + 'doc_ids.npy')
+			self.rows = {doc_id : row for row, doc_id in enumerate(self.doc_ids.tolist())}
+
+	def __len__(self):
+		return self.meta['num_documents']
+
+	# Token ids of every sentence of document doc_id, as zero-copy slices of tokens.bin
+	def get(self, doc_id):
+		self.open()
+		row = self.rows[doc_id]
+		sent_offsets = self.sent_offsets[self.doc_offsets[row]:self.doc_offsets[row+1] + 1]
+		return [self.tokens[sent_offsets[i]:sent_offsets[i+1]] for i in range(len(sent_offsets) - 1)]
+
+# Writes sentence embeddings of a split with num_sentences sentences into a memory-mapped float16 array
+# Rows can be written in any order, doc_offsets and doc_ids are given on close
+class EmbeddingWriter:
+	def __init__(self, path, num_sentences, dim):
+		self.path = path
+		self.embeddings = np.lib.format.open_memmap(path + 'embeddings.npy', mode='w+', dtype=np.float16, shape=(num_sentences, dim))
+
+	def write(self, rows, embeddings):
+		self.embeddings[rows] = embeddings
+
+	def close(self, doc_offsets, doc_ids, meta):
+		self.embeddings.flush()
+		del self.embeddings
+		np.save(self.path + 'doc_offsets.npy', np.asarray(doc_offsets, dtype=np.int64))
+		np.save(self.path + 'doc_ids.npy', np.asarray(doc_ids, dtype=np.int64))
+		# Meta is written last so that a split is only picked up by readers once it is complete
+		with open(self.path + EMBEDDING_META_FILE, 'w') as outfile:
+			json.dump(meta, outfile)
+
+def has_embedding_split(path):
+	return os.path.exists(path + EMBEDDING_META_FILE)
+
+# Memory-mapped embeddings, document offsets and document ids of a split, like load_sparse_split
+def load_embedding_split(path):
+	return np.load(path + 'embeddings.npy', mmap_mode='r'), np.load(path + 'doc_offsets.npy'), np.load(path + 'doc_ids.npy')
+
+# Format of a split's features: sparse (features.npz), packed (packed.json), embedding (embedding.json)
+# or pt (one .pt file per document)
+def get_split_format(path):
+	if(has_sparse_split(path)):
+		return 'sparse'
+	elif(has_packed_split(path)):
+		return 'packed'
+	elif(has_embedding_split(path)):
+		return 'embedding'
+	return 'pt'